@@ -0,0 +1,89 @@
+import asyncio
+import os
+from collections import deque
+from typing import Deque
+
+from .metrics import metrics
+
+class UpstreamSaturated(Exception):
+    """Raised instead of queueing when the upstream concurrency limit is exhausted."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Upstream is saturated ({reason}); retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Bounds concurrent upstream calls, with a bounded FIFO wait queue.
+
+    Up to ``max_concurrency`` callers hold a slot at once. Further callers wait
+    in line, at most ``max_queue`` of them and for at most ``queue_timeout``
+    seconds; anyone beyond that is rejected immediately with
+    :class:`UpstreamSaturated`. A released slot is handed straight to the
+    oldest waiter, so a burst cannot overtake callers already in line.
+    """
+
+    def __init__(self, max_concurrency: int = 50, max_queue: int = 100, queue_timeout: float = 10.0, retry_after: int = 5):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self):
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self._admitted(0.0)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full")
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        metrics.set("upstream_queue_depth", len(self._waiters))
+        started = loop.time()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed over just as we gave up; pass it on
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("queue_timeout")
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            metrics.set("upstream_queue_depth", len(self._waiters))
+        self._admitted(loop.time() - started)
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot moves to the waiter; ``active`` stays the same
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        metrics.set("upstream_active", self.active)
+
+    def _admitted(self, waited: float):
+        metrics.inc("upstream_admitted_total")
+        metrics.inc("upstream_queue_wait_seconds_total", waited)
+        metrics.set("upstream_last_queue_wait_seconds", round(waited, 4))
+        metrics.set("upstream_active", self.active)
+
+    def _reject(self, reason: str):
+        metrics.inc(f"upstream_rejected_{reason}_total")
+        raise UpstreamSaturated(reason, self.retry_after)
+
+def create_admission_controller() -> AdmissionController:
+    return AdmissionController(
+        max_concurrency=int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "50")),
+        max_queue=int(os.getenv("UPSTREAM_MAX_QUEUE", "100")),
+        queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "10")),
+        retry_after=int(os.getenv("UPSTREAM_RETRY_AFTER", "5")),
+    )
@@ -0,0 +1,162 @@
+import math
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+from .metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Exported as circuit_<name>_state
+_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+class CircuitOpenError(Exception):
+    """The circuit for an upstream endpoint is open; calls fail without being sent."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"Dify {name} is unavailable (circuit open); retry after {retry_after}s")
+        self.name = name
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a rolling window of recent calls.
+
+    The circuit opens once at least ``minimum_calls`` of the last
+    ``window_size`` calls were seen and either the failure rate or the share of
+    calls slower than ``slow_call_duration`` reaches its threshold. While open,
+    calls fail immediately with :class:`CircuitOpenError`. After
+    ``open_duration`` seconds up to ``half_open_max_calls`` probe calls are let
+    through; that many successes close the circuit, any failure reopens it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        slow_call_duration: float = 10.0,
+        slow_call_rate_threshold: float = 0.8,
+        window_size: int = 20,
+        minimum_calls: int = 10,
+        open_duration: float = 30.0,
+        half_open_max_calls: int = 2
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.window_size = window_size
+        self.minimum_calls = minimum_calls
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = CLOSED
+        self._window: Deque[Tuple[bool, bool]] = deque()  # (failed, slow)
+        self._failures = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._export_state()
+
+    def allow(self) -> bool:
+        """Admit a call or raise :class:`CircuitOpenError`; returns whether it is a probe."""
+        if self.state == OPEN:
+            remaining = self._opened_at + self.open_duration - time.monotonic()
+            if remaining > 0:
+                metrics.inc(f"circuit_{self.name}_rejected_total")
+                raise CircuitOpenError(self.name, math.ceil(remaining))
+            self._transition(HALF_OPEN)
+
+        if self.state == HALF_OPEN:
+            if self._probes_in_flight + self._probe_successes >= self.half_open_max_calls:
+                metrics.inc(f"circuit_{self.name}_rejected_total")
+                raise CircuitOpenError(self.name, 1)
+            self._probes_in_flight += 1
+            return True
+        return False
+
+    def available(self) -> bool:
+        """Whether :meth:`allow` would currently let a call through."""
+        if self.state == OPEN:
+            return self._opened_at + self.open_duration <= time.monotonic()
+        if self.state == HALF_OPEN:
+            return self._probes_in_flight + self._probe_successes < self.half_open_max_calls
+        return True
+
+    def record(self, probe: bool, failed: bool, duration: float):
+        slow = duration >= self.slow_call_duration
+        if slow:
+            metrics.inc(f"circuit_{self.name}_slow_calls_total")
+        if probe:
+            self._probes_in_flight -= 1
+            if self.state != HALF_OPEN:
+                return
+            if failed or slow:
+                self._transition(OPEN)
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_max_calls:
+                self._transition(CLOSED)
+            return
+
+        if self.state != CLOSED:
+            return
+        self._window.append((failed, slow))
+        self._failures += failed
+        self._slow += slow
+        if len(self._window) > self.window_size:
+            old_failed, old_slow = self._window.popleft()
+            self._failures -= old_failed
+            self._slow -= old_slow
+
+        calls = len(self._window)
+        if calls >= self.minimum_calls and (
+            self._failures / calls >= self.failure_rate_threshold
+            or self._slow / calls >= self.slow_call_rate_threshold
+        ):
+            self._transition(OPEN)
+
+    def release(self, probe: bool):
+        """End a call whose outcome says nothing about upstream health (e.g. cancelled)."""
+        if probe:
+            self._probes_in_flight -= 1
+
+    def _transition(self, state: str):
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            metrics.inc(f"circuit_{self.name}_opened_total")
+        self._window.clear()
+        self._failures = self._slow = 0
+        self._probe_successes = 0
+        self._export_state()
+
+    def _export_state(self):
+        metrics.set(f"circuit_{self.name}_state", _STATE_VALUES[self.state])
+
+class CircuitBreakers:
+    """One breaker per upstream endpoint, created on first use with shared settings."""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name, **self.settings)
+        return breaker
+
+def create_circuit_breakers() -> CircuitBreakers:
+    return CircuitBreakers(
+        failure_rate_threshold=float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5")),
+        slow_call_duration=float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "10")),
+        slow_call_rate_threshold=float(os.getenv("CIRCUIT_SLOW_CALL_RATE", "0.8")),
+        window_size=int(os.getenv("CIRCUIT_WINDOW_SIZE", "20")),
+        minimum_calls=int(os.getenv("CIRCUIT_MINIMUM_CALLS", "10")),
+        open_duration=float(os.getenv("CIRCUIT_OPEN_SECONDS", "30")),
+        half_open_max_calls=int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "2")),
+    )
@@ -0,0 +1,83 @@
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import insert, select
+
+from .database import ConversationAlias, async_session, utcnow
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Version nibble of a UUID held as a 128-bit int
+_VERSION_SHIFT = 76
+
+class ConversationAliases:
+    """Conversation ids handed out with answers the caller did not generate.
+
+    A coalesced or cached answer belongs to another caller's Dify conversation,
+    which must not be shared, so its recipient gets a fresh alias instead: a
+    version-8 UUID, recognisable without any state (Dify issues version 4).
+    The alias's next turn opens a new Dify conversation and later turns
+    continue it. Bindings are stored in the ``conversation_aliases`` table, so
+    every instance of the app continues the same conversation; the last
+    ``max_entries`` used are also kept in memory. A binding never changes
+    once written.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._bindings: "OrderedDict[str, str]" = OrderedDict()
+
+    def create(self) -> str:
+        value = uuid.uuid4().int & ~(0xF << _VERSION_SHIFT) | (0x8 << _VERSION_SHIFT)
+        metrics.inc("conversation_aliases_created_total")
+        return str(uuid.UUID(int=value))
+
+    @staticmethod
+    def is_alias(conversation_id: str) -> bool:
+        try:
+            return uuid.UUID(conversation_id).version == 8
+        except ValueError:
+            return False
+
+    async def resolve(self, alias: str) -> Optional[str]:
+        """The Dify conversation ``alias`` is bound to, if any."""
+        conversation_id = self._bindings.get(alias)
+        if conversation_id is not None:
+            self._bindings.move_to_end(alias)
+            return conversation_id
+
+        metrics.inc("conversation_alias_lookups_total")
+        async with async_session() as session:
+            conversation_id = await session.scalar(
+                select(ConversationAlias.conversation_id).where(ConversationAlias.alias == alias)
+            )
+        if conversation_id is not None:
+            self._remember(alias, conversation_id)
+        return conversation_id
+
+    async def bind(self, alias: str, conversation_id: str):
+        self._remember(alias, conversation_id)
+        try:
+            async with async_session() as session:
+                await session.execute(insert(ConversationAlias).values(
+                    alias=alias, conversation_id=conversation_id, created_at=utcnow()
+                ))
+                await session.commit()
+        except Exception:
+            # Typically a concurrent first turn on another instance bound it
+            # first; this instance keeps its own binding in memory
+            metrics.inc("conversation_alias_bind_failures_total")
+            logger.exception("Failed to store conversation alias %s", alias)
+
+    def _remember(self, alias: str, conversation_id: str):
+        self._bindings[alias] = conversation_id
+        self._bindings.move_to_end(alias)
+        while len(self._bindings) > self.max_entries:
+            self._bindings.popitem(last=False)
+
+def create_conversation_aliases() -> ConversationAliases:
+    return ConversationAliases(max_entries=int(os.getenv("CONVERSATION_ALIAS_MAX_ENTRIES", "100000")))
@@ -1,25 +1,181 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
-from sqlalchemy import Column, String, DateTime
-from datetime import datetime
+from sqlalchemy import Column, String, DateTime, Index, Uuid, event
+from sqlalchemy.types import TypeDecorator
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
 import os
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
-engine = create_async_engine(DATABASE_URL, echo=True)
+from .metrics import metrics
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+def _env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+def _normalize_url(url: str) -> str:
+    # Hosting providers hand out postgres:// URLs; use the async psycopg 3 driver
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    return url
+
+DATABASE_URL = _normalize_url(os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./chat.db"))
+
+# Engine tuning; pool settings are ignored for in-memory SQLite, which shares
+# one connection, and statement timeouts are only enforced by PostgreSQL.
+DATABASE_ECHO = _env_bool("DATABASE_ECHO", False)
+DATABASE_POOL_SIZE = _env_int("DATABASE_POOL_SIZE", 5)
+DATABASE_MAX_OVERFLOW = _env_int("DATABASE_MAX_OVERFLOW", 10)
+DATABASE_POOL_PRE_PING = _env_bool("DATABASE_POOL_PRE_PING", True)
+DATABASE_POOL_RECYCLE = _env_int("DATABASE_POOL_RECYCLE", 1800)
+DATABASE_STATEMENT_TIMEOUT_MS = _env_int("DATABASE_STATEMENT_TIMEOUT_MS", 30000)
+# psycopg prepares a statement server-side once it has run this many times
+# on a connection; set to 0 to disable (e.g. behind PgBouncer in transaction mode)
+DATABASE_PREPARE_THRESHOLD = _env_int("DATABASE_PREPARE_THRESHOLD", 2)
+
+# Applied to every connection of a file-backed SQLite database
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": _env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+    "cache_size": _env_int("SQLITE_CACHE_SIZE", -64000),  # negative = KiB, i.e. 64 MB
+    "busy_timeout": _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000),
+    "temp_store": "MEMORY",
+}
+
+def _is_sqlite_file(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+def _engine_options(url: str) -> Dict[str, Any]:
+    parsed = make_url(url)
+    options: Dict[str, Any] = {"echo": DATABASE_ECHO}
+    if parsed.get_backend_name() == "sqlite" and not _is_sqlite_file(url):
+        return options
+
+    options.update(
+        pool_size=DATABASE_POOL_SIZE,
+        max_overflow=DATABASE_MAX_OVERFLOW,
+        # A local SQLite file cannot drop the connection, so skip the extra
+        # round trip per checkout there.
+        pool_pre_ping=DATABASE_POOL_PRE_PING and parsed.get_backend_name() != "sqlite",
+        pool_recycle=DATABASE_POOL_RECYCLE,
+    )
+    if parsed.get_backend_name() == "postgresql":
+        connect_args: Dict[str, Any] = {}
+        if DATABASE_STATEMENT_TIMEOUT_MS:
+            connect_args["options"] = f"-c statement_timeout={DATABASE_STATEMENT_TIMEOUT_MS}"
+        if parsed.get_driver_name() == "psycopg":
+            connect_args["prepare_threshold"] = DATABASE_PREPARE_THRESHOLD or None
+        options["connect_args"] = connect_args
+    return options
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    metrics.inc("db_statements_total")
+
+def build_engine(url: str, tune_sqlite: bool = True) -> AsyncEngine:
+    new_engine = create_async_engine(url, **_engine_options(url))
+    if tune_sqlite and _is_sqlite_file(url):
+        event.listen(new_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    event.listen(new_engine.sync_engine, "before_cursor_execute", _count_statement)
+    return new_engine
+
+engine = build_engine(DATABASE_URL)
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+class UTCDateTime(TypeDecorator):
+    """``timestamptz`` on PostgreSQL; naive UTC on SQLite, which has no time zones.
+
+    Values always come back timezone-aware (UTC) on both backends.
+    """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        if dialect.name == "sqlite":
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
 class Base(DeclarativeBase):
     pass
 
 class Conversation(Base):
     __tablename__ = "conversations"
 
-    id = Column(String, primary_key=True)
+    # Native uuid columns on PostgreSQL, CHAR(32) on SQLite; both read back as str
+    id = Column(Uuid(as_uuid=False), primary_key=True)
     user_message = Column(String, nullable=False)
     assistant_message = Column(String, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(UTCDateTime, default=utcnow)
+    conversation_id = Column(Uuid(as_uuid=False), nullable=False)
+
+    __table_args__ = (
+        Index("idx_conversation_id", "conversation_id"),
+        # History pages are keyed on (timestamp, id); see get_chat_history
+        Index("idx_timestamp", "timestamp", "id"),
+        # Per-thread history: WHERE conversation_id = ? ORDER BY timestamp DESC, id DESC
+        Index("idx_conversation_id_timestamp", "conversation_id", "timestamp", "id"),
+    )
+
+class ConversationAlias(Base):
+    """A conversation id handed out in place of another caller's (see ConversationAliases)."""
+
+    __tablename__ = "conversation_aliases"
+
+    alias = Column(Uuid(as_uuid=False), primary_key=True)
+    # Dify's id, stored as given
     conversation_id = Column(String, nullable=False)
+    created_at = Column(UTCDateTime, default=utcnow, nullable=False)
+
+def get_engine_config() -> Dict[str, Any]:
+    options = _engine_options(DATABASE_URL)
+    return {
+        "url": engine.url.render_as_string(hide_password=True),
+        "dialect": engine.dialect.name,
+        "driver": engine.dialect.driver,
+        "echo": engine.echo,
+        "pool_class": type(engine.pool).__name__,
+        "pool_status": engine.pool.status(),
+        "pool_size": options.get("pool_size"),
+        "max_overflow": options.get("max_overflow"),
+        "pool_pre_ping": options.get("pool_pre_ping"),
+        "pool_recycle": options.get("pool_recycle"),
+        "statement_timeout_ms": DATABASE_STATEMENT_TIMEOUT_MS if "connect_args" in options else None,
+        "prepare_threshold": options.get("connect_args", {}).get("prepare_threshold"),
+        "sqlite_pragmas": SQLITE_PRAGMAS if _is_sqlite_file(DATABASE_URL) else None,
+    }
+
+def _create_schema(connection):
+    Base.metadata.create_all(connection)
+    # create_all skips indexes of tables that already exist, so databases
+    # created before an index was declared get it here.
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
 
 async def init_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_schema)
@@ -1,94 +1,678 @@
 import httpx
+import asyncio
+import logging
 import os
 import json
+import math
+import time
+from contextlib import aclosing, asynccontextmanager
 import uuid
-from typing import Optional, Dict, AsyncGenerator
+from typing import Optional, Callable, Coroutine, Dict, AsyncGenerator, List, Set, Tuple
+
+from .metrics import metrics
+from .sse import aiter_events
+from .single_flight import SingleFlight, normalize_message
+from .conversation_aliases import ConversationAliases, create_conversation_aliases
+from .response_cache import ResponseCache, cache_key, create_response_cache
+from .semantic_cache import SemanticCache, create_semantic_cache
+from .admission import create_admission_controller
+from .rate_limit import UpstreamRateLimited, estimate_tokens, parse_retry_after
+from .retry import RETRYABLE_STATUS_CODES, RETRYABLE_TRANSPORT_ERRORS, create_retry_policy
+from .circuit_breaker import CircuitOpenError, create_circuit_breakers
+from .timeouts import DifyTimeoutError, StreamBudget, create_http_timeout, httpx_timeout_error
+from .hedging import Hedger, create_hedger
+from .upstreams import Upstream, create_upstream_pool
+
+logger = logging.getLogger(__name__)
+
+# Dify stream events that carry a piece of the answer
+ANSWER_EVENTS = ("message", "agent_message")
+
+class DifyStreamError(Exception):
+    """An ``error`` event reported by Dify in the middle of a stream."""
+
+def _extract_conversation_id(chunk: dict) -> Optional[str]:
+    # Try to get conversation_id from various locations
+    data = chunk.get("data")
+    return (
+        chunk.get("conversation_id") or
+        chunk.get("id") or
+        (data.get("conversation_id") if isinstance(data, dict) else None)
+    )
 
 class DifyClient:
     def __init__(self):
-        self.api_key = os.getenv("DIFY_API_KEY")
-        self.base_url = "https://api.dify.ai/v1"
-        if not self.api_key:
-            raise ValueError("DIFY_API_KEY must be set")
-
-    async def chat(self, message: str, conversation_id: Optional[str] = None) -> Dict[str, str]:
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "Accept": "text/event-stream"
+        self.user = "default-user"
+
+        # Connection pool settings for the shared httpx client
+        self.max_connections = int(os.getenv("DIFY_MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(os.getenv("DIFY_MAX_KEEPALIVE_CONNECTIONS", "20"))
+        self.keepalive_expiry = float(os.getenv("DIFY_KEEPALIVE_EXPIRY", "30"))
+        self.http2 = os.getenv("DIFY_HTTP2", "false").lower() in ("1", "true", "yes")
+
+        # Opt-in coalescing of identical concurrent new-conversation requests
+        self.single_flight: Optional[SingleFlight] = None
+        if os.getenv("DIFY_SINGLE_FLIGHT", "false").lower() in ("1", "true", "yes"):
+            self.single_flight = SingleFlight()
+        # Conversation ids given out with shared answers, in place of the Dify
+        # conversation that produced them (CONVERSATION_ALIAS_MAX_ENTRIES)
+        self.aliases: ConversationAliases = create_conversation_aliases()
+
+        # Optional exact-match cache of first-turn answers (RESPONSE_CACHE_*)
+        self.response_cache: Optional[ResponseCache] = create_response_cache()
+        # Optional similarity-based cache consulted after an exact-match miss (SEMANTIC_CACHE_*)
+        self.semantic_cache: Optional[SemanticCache] = create_semantic_cache()
+
+        # Bounds concurrent Dify streams (UPSTREAM_MAX_CONCURRENCY); excess callers
+        # queue briefly or are rejected with UpstreamSaturated
+        self.admission = create_admission_controller()
+        # Retries for failures before any answer bytes arrive (DIFY_RETRY_*)
+        self.retry_policy = create_retry_policy()
+        # Per-endpoint circuit breakers that fail fast while Dify is degraded (CIRCUIT_*)
+        self.breakers = create_circuit_breakers()
+        # Dify apps to balance over (DIFY_UPSTREAMS, or DIFY_API_URL + DIFY_API_KEY);
+        # each has its own client-side rate limiter (DIFY_RATE_LIMIT_*)
+        self.pool = create_upstream_pool(self.breakers)
+
+        # Time budgets: connect/idle/write/pool per HTTP operation, plus the wait
+        # for the first answer delta and the whole call (DIFY_*_TIMEOUT)
+        self.http_timeout = create_http_timeout()
+        self.first_event_timeout = float(os.getenv("DIFY_FIRST_EVENT_TIMEOUT", "60"))
+        self.total_timeout = float(os.getenv("DIFY_TOTAL_TIMEOUT", "300"))
+
+        # Optional backup requests for first turns with a slow first delta (DIFY_HEDGE*)
+        self.hedger: Optional[Hedger] = create_hedger()
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._background_tasks: Set[asyncio.Task] = set()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def start(self):
+        if self._client is None:
+            # http2=True requires the optional "h2" package (httpx[http2])
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                http2=self.http2,
+            )
+            metrics.set("dify_pool_max_connections", self.max_connections)
+
+    async def close(self):
+        # Background tasks may start others (a closed hedge loser sends a stop)
+        while self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self.response_cache is not None:
+            await self.response_cache.close()
+        if self.semantic_cache is not None:
+            await asyncio.to_thread(self.semantic_cache.save)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("DifyClient.start() must be awaited before use")
+        return self._client
+
+    def _acquire(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        metrics.inc("dify_requests_total")
+        if self.in_flight > self.max_connections:
+            metrics.inc("dify_pool_saturated_total")
+        metrics.set("dify_pool_in_flight", self.in_flight)
+        metrics.set("dify_pool_peak_in_flight", self.peak_in_flight)
+
+    def _release(self):
+        self.in_flight -= 1
+        metrics.set("dify_pool_in_flight", self.in_flight)
+
+    async def chat(
+        self,
+        message: str,
+        conversation_id: Optional[str] = None,
+        use_cache: bool = True,
+        timeout: Optional[float] = None
+    ) -> Dict[str, str]:
+        answer_parts = []
+        current_conversation_id = None
+        cached = False
+        async with aclosing(self.chat_stream(message, conversation_id, use_cache, timeout)) as events:
+            async for event in events:
+                current_conversation_id = event["conversation_id"]
+                if event["event"] == "message":
+                    answer_parts.append(event["answer"])
+                elif event["event"] == "message_end":
+                    cached = event.get("cached", False)
+
+        return {
+            "answer": "".join(answer_parts).strip(),
+            "conversation_id": current_conversation_id,
+            "cached": cached
         }
-        
+
+    def chat_stream(
+        self,
+        message: str,
+        conversation_id: Optional[str] = None,
+        use_cache: bool = True,
+        timeout: Optional[float] = None
+    ) -> AsyncGenerator[Dict[str, str], None]:
+        """Yield answer deltas as they arrive from Dify.
+
+        Each item is ``{"event": "message", "answer": <delta>, "conversation_id": ...}``;
+        the stream always finishes with a single ``{"event": "message_end", ...}`` item,
+        which carries ``"cached": True`` when the answer came from the response cache.
+        With ``use_cache=False`` the cache is not read, but a fresh answer still replaces
+        the cached one. ``timeout`` is the caller's own deadline in seconds, on top of
+        the configured budgets.
+        """
+        if conversation_id and self.aliases.is_alias(conversation_id):
+            return self._stream_aliased(message, conversation_id, timeout)
+        if not conversation_id and (self.response_cache is not None or self.semantic_cache is not None):
+            return self._stream_through_cache(message, use_cache, timeout)
+        return self._stream_new(message, conversation_id, timeout)
+
+    async def _stream_through_cache(
+        self, message: str, use_cache: bool, timeout: Optional[float]
+    ) -> AsyncGenerator[Dict[str, str], None]:
+        key = cache_key(message)
+        if use_cache:
+            hit = None
+            if self.response_cache is not None:
+                hit = await self.response_cache.get(key)
+            if hit is None and self.semantic_cache is not None:
+                hit = self.semantic_cache.get(message)
+            if hit is not None:
+                # The answer is shared, the Dify conversation that produced it is not
+                alias = self.aliases.create()
+                yield {"event": "message", "answer": hit["answer"], "conversation_id": alias}
+                yield {"event": "message_end", "answer": "", "conversation_id": alias, "cached": True}
+                return
+        else:
+            metrics.inc("response_cache_bypassed_total")
+
+        answer_parts = []
+        async with aclosing(self._stream_new(message, None, timeout)) as events:
+            async for event in events:
+                if event["event"] == "message":
+                    answer_parts.append(event["answer"])
+                elif event["event"] == "message_end":
+                    # Only complete, non-empty answers are cached
+                    answer = "".join(answer_parts)
+                    if answer.strip():
+                        value = {"answer": answer}
+                        if self.response_cache is not None:
+                            await self.response_cache.set(key, value)
+                        if self.semantic_cache is not None:
+                            self.semantic_cache.set(message, value)
+                yield event
+
+    def _stream_new(
+        self, message: str, conversation_id: Optional[str], timeout: Optional[float]
+    ) -> AsyncGenerator[Dict[str, str], None]:
+        if conversation_id:
+            return self._stream_upstream(message, conversation_id, timeout)
+        if self.single_flight is not None:
+            return self._stream_coalesced(message, timeout)
+        return self._stream_first_turn(message, timeout)
+
+    async def _stream_coalesced(self, message: str, timeout: Optional[float]) -> AsyncGenerator[Dict[str, str], None]:
+        """Share one generation between identical concurrent first turns.
+
+        The shared call runs on the configured budgets; each caller's own deadline
+        is enforced while it waits. Only the caller that started the call keeps
+        its Dify conversation, the others get an alias (see ConversationAliases).
+        """
+        leader = False
+
+        def start():
+            # Called by SingleFlight for the first caller only
+            nonlocal leader
+            leader = True
+            return self._stream_first_turn(message, None)
+
+        alias = None
+        try:
+            async with aclosing(self.single_flight.stream(normalize_message(message), start, timeout)) as events:
+                async for event in events:
+                    if not leader:
+                        alias = alias or self.aliases.create()
+                        event = {**event, "conversation_id": alias}
+                    yield event
+        except TimeoutError:
+            metrics.inc("dify_client_deadline_budget_exceeded_total")
+            raise DifyTimeoutError("client_deadline", timeout) from None
+
+    async def _stream_aliased(
+        self, message: str, alias: str, timeout: Optional[float]
+    ) -> AsyncGenerator[Dict[str, str], None]:
+        """Continue a conversation known to the caller by an alias."""
+        conversation_id = await self.aliases.resolve(alias)
+        bound = conversation_id is not None
+        if bound:
+            stream = self._stream_upstream(message, conversation_id, timeout)
+        else:
+            # First generated turn: open a Dify conversation of its own
+            stream = self._stream_first_turn(message, timeout)
+        async with aclosing(stream) as events:
+            async for event in events:
+                conversation_id = conversation_id or event["conversation_id"]
+                if not bound and event["event"] == "message_end":
+                    # Stored before the turn completes, so the next one sees it
+                    # whichever instance it reaches
+                    await self.aliases.bind(alias, conversation_id)
+                yield {**event, "conversation_id": alias}
+
+    def _stream_first_turn(self, message: str, timeout: Optional[float]) -> AsyncGenerator[Dict[str, str], None]:
+        if self.hedger is not None:
+            return self._stream_hedged(message, timeout)
+        return self._stream_upstream(message, None, timeout)
+
+    async def _stream_hedged(self, message: str, timeout: Optional[float]) -> AsyncGenerator[Dict[str, str], None]:
+        """Stream a first turn, sending a backup request if the first delta is slow.
+
+        Only new conversations are hedged, since a duplicate turn in an existing
+        conversation would change its history. Both calls run against the
+        request's deadlines, measured from when the primary started. Whichever
+        call produces its first event first is kept; the other is closed, which
+        drops its connection and stops its Dify task.
+        """
+        loop = asyncio.get_running_loop()
+        self.hedger.record_request()
+        delay = self.hedger.delay()
+        started = loop.time()
+
+        # first-event task -> (stream, start time, Dify task id); the primary comes first
+        calls: Dict[asyncio.Task, Tuple[AsyncGenerator, float, asyncio.Future]] = {}
+
+        def launch(upstream: Upstream):
+            task_id = loop.create_future()
+            stream = self._stream_upstream(
+                message, None, timeout, upstream, started=started, on_task_id=task_id.set_result
+            )
+            calls[asyncio.ensure_future(anext(stream))] = (stream, loop.time(), task_id)
+
+        primary = self.pool.pick()
+        launch(primary)
+        pending = set(calls)
+        hedged = False
+        winner = None
+        try:
+            while winner is None:
+                if not pending:
+                    # Every call failed; report the primary's error
+                    raise next(iter(calls)).exception()
+                wait = None if hedged else max(started + delay - loop.time(), 0)
+                done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                for task in calls:
+                    if task in done and winner is None and task.exception() is None:
+                        winner = task
+                if winner is None and not done and not hedged:
+                    hedged = True
+                    if self.hedger.try_hedge():
+                        # Prefer another upstream for the backup
+                        launch(self.pool.pick(exclude=[primary.name]))
+                        pending = {task for task in calls if not task.done()}
+        finally:
+            for task, (stream, _, task_id) in calls.items():
+                if task is winner:
+                    continue
+                if winner is not None and not (task.done() or task_id.done()):
+                    # Closing it now would leave Dify generating with no task id
+                    # to stop, so it is closed once Dify reports one. Without a
+                    # winner (e.g. the client went away) everything closes now.
+                    metrics.inc("dify_hedge_deferred_stops_total")
+                    self._run_in_background(self._close_hedge_loser(task, stream, task_id))
+                else:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    await stream.aclose()
+
+        stream, call_started, _ = calls[winner]
+        self.hedger.record_first_event(loop.time() - call_started)
+        if winner is not next(iter(calls)):
+            metrics.inc("dify_hedge_wins_total")
+        async with aclosing(stream):
+            yield winner.result()
+            async for event in stream:
+                yield event
+
+    @staticmethod
+    async def _close_hedge_loser(task: asyncio.Task, stream: AsyncGenerator, task_id: asyncio.Future):
+        # Bounded by the call's own budgets, which end the task at the latest
+        await asyncio.wait((task, task_id), return_when=asyncio.FIRST_COMPLETED)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await stream.aclose()
+
+    async def _stream_upstream(
+        self,
+        message: str,
+        conversation_id: Optional[str],
+        timeout: Optional[float] = None,
+        upstream: Optional[Upstream] = None,
+        started: Optional[float] = None,
+        on_task_id: Optional[Callable[[str], None]] = None
+    ) -> AsyncGenerator[Dict[str, str], None]:
+        candidates = [upstream] if upstream is not None else self.pool.candidates(conversation_id)
         payload = {
             "inputs": {},
             "query": message,
-            "user": "default-user",
+            "user": self.user,
             "response_mode": "streaming",
             "conversation_id": conversation_id if conversation_id else None
         }
-        
-        print(f"Request payload structure: {list(payload.keys())}")
 
+        task_id = None
+        finished = False
+        budget = StreamBudget(self.first_event_timeout, self.total_timeout, timeout, started)
+        budget_name, deadline = budget.next()
         try:
-            async with httpx.AsyncClient() as client:
-                endpoint = f"{self.base_url}/chat-messages"
-                print(f"Sending request to Dify API: {endpoint}")
-                print(f"Payload: {payload}")
-                print(f"Headers: {headers}")
+            async with asyncio.timeout_at(deadline):
+                await self.admission.acquire()
+        except TimeoutError:
+            raise budget.exceeded(budget_name) from None
+        self._acquire()
+        try:
+            # Checked once per request so per-event tracing costs nothing when disabled
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                logger.debug(
+                    "Sending request to Dify API",
+                    extra={"upstreams": [c.name for c in candidates], "payload_keys": list(payload)}
+                )
+            
+            estimated_tokens = estimate_tokens(message)
+            async with self._open_stream(candidates, payload, estimated_tokens, budget) as (upstream, response):
+                if response.is_error:
+                    await response.aread()
+                    logger.warning(
+                        "Dify API returned an error",
+                        extra={"status_code": response.status_code, "body": response.text[:1000]}
+                    )
+                response.raise_for_status()
                 
-                async with client.stream(
-                    "POST",
-                    endpoint,
-                    headers=headers,
-                    json=payload,
-                    timeout=30.0
-                ) as response:
-                    response.raise_for_status()
-                    
-                    full_response = ""
-                    current_conversation_id = None
-                    
-                    async for line in response.aiter_lines():
-                        print(f"Received line: {line}")
-                        if not line.strip():
-                            continue
-                            
-                        if line.startswith("data: "):
-                            data = line[6:].strip()  # Remove "data: " prefix
-                            if data == "[DONE]":
-                                break
-                                
-                            try:
-                                chunk = json.loads(data)
-                                print(f"Parsed chunk: {chunk}")
-                                if isinstance(chunk, dict):
-                                    message_data = chunk.get("answer", "")
-                                    if message_data:
-                                        full_response += message_data
-                                    
-                                    # Try to get conversation_id from various locations
-                                    if not current_conversation_id:
-                                        current_conversation_id = (
-                                            chunk.get("conversation_id") or
-                                            chunk.get("id") or
-                                            (chunk.get("data", {}).get("conversation_id") if isinstance(chunk.get("data"), dict) else None)
-                                        )
-                            except json.JSONDecodeError as e:
-                                print(f"Error parsing chunk: {e}")
-                                continue
-                    
-                    # If we didn't get a conversation_id, generate one
-                    if not current_conversation_id:
-                        current_conversation_id = str(uuid.uuid4())
-                    
-                    return {
-                        "answer": full_response.strip(),
-                        "conversation_id": current_conversation_id
-                    }
+                current_conversation_id = None
+                
+                # Deadlines are applied to each read only: a timeout spanning the
+                # yields below would cancel the consumer rather than this stream.
+                events = aiter_events(response.aiter_text())
+                while True:
+                    budget_name, deadline = budget.next()
+                    try:
+                        async with asyncio.timeout_at(deadline):
+                            sse = await anext(events)
+                    except StopAsyncIteration:
+                        break
+                    except TimeoutError:
+                        raise budget.exceeded(budget_name) from None
+                    if debug:
+                        logger.debug("Received event", extra={"sse_event": sse.event, "sse_data": sse.data})
+                    data = sse.data.strip()
+                    if data == "[DONE]":
+                        break
+                    if sse.event == "ping":
+                        continue
+
+                    try:
+                        chunk = json.loads(data)
+                    except json.JSONDecodeError as e:
+                        logger.warning("Error parsing Dify stream chunk: %s", e)
+                        continue
+                    if not isinstance(chunk, dict):
+                        continue
+
+                    if task_id is None:
+                        task_id = chunk.get("task_id")
+                        if task_id and on_task_id is not None:
+                            on_task_id(task_id)
+                    if current_conversation_id is None:
+                        current_conversation_id = _extract_conversation_id(chunk)
+                        if current_conversation_id:
+                            self.pool.bind(current_conversation_id, upstream)
+
+                    event_type = chunk.get("event", sse.event)
+                    if event_type in ANSWER_EVENTS:
+                        message_data = chunk.get("answer")
+                        if message_data:
+                            budget.first_event_seen = True
+                            yield {
+                                "event": "message",
+                                "answer": message_data,
+                                "conversation_id": current_conversation_id
+                            }
+                    elif event_type == "message_end":
+                        usage = (chunk.get("metadata") or {}).get("usage") or {}
+                        if isinstance(usage.get("total_tokens"), int):
+                            upstream.rate_limiter.record_usage(estimated_tokens, usage["total_tokens"])
+                        break
+                    elif event_type == "error":
+                        raise DifyStreamError(chunk.get("message") or sse.data)
+                
+                # If we didn't get a conversation_id, generate one
+                if not current_conversation_id:
+                    current_conversation_id = str(uuid.uuid4())
+                
+                finished = True
+                yield {
+                    "event": "message_end",
+                    "answer": "",
+                    "conversation_id": current_conversation_id
+                }
                     
+        except (asyncio.CancelledError, GeneratorExit):
+            # The consumer went away mid-stream: leaving the ``stream`` context
+            # drops the upstream connection, and Dify is told to stop generating.
+            if not finished:
+                metrics.inc("dify_cancelled_total")
+                if task_id:
+                    self._stop_in_background(task_id, upstream)
+            raise
+        except httpx.TimeoutException as e:
+            logger.error("Timed out calling Dify API: %r", e)
+            if task_id:
+                self._stop_in_background(task_id, upstream)
+            raise httpx_timeout_error(e, self.http_timeout) from e
         except httpx.HTTPError as e:
-            print(f"HTTP Error: {str(e)}")
-            print(f"Response content: {e.response.content if hasattr(e, 'response') else 'No response content'}")
+            logger.error("HTTP error calling Dify API: %s", e)
+            raise
+        except DifyTimeoutError as e:
+            logger.error("Dify call exceeded its %s budget", e.budget)
+            if task_id:
+                self._stop_in_background(task_id, upstream)
             raise
-        except Exception as e:
-            print(f"Unexpected error: {str(e)}")
+        except (UpstreamRateLimited, CircuitOpenError):
             raise
+        except Exception:
+            logger.exception("Unexpected error in Dify stream")
+            raise
+        finally:
+            self._release()
+            self.admission.release()
+
+    @asynccontextmanager
+    async def _open_stream(
+        self, candidates: List[Upstream], payload: dict, estimated_tokens: int, budget: StreamBudget
+    ):
+        """Send the chat request and yield ``(upstream, response)``.
+
+        Each attempt is admitted by the upstream's circuit breaker and then waits
+        for its rate limiter.
+        Failures before any of the response body is read (connection errors,
+        429 and 502/503/504; any transport error for a new conversation) are
+        retried with backoff under ``retry_policy``; a 404 from a candidate that
+        does not know the conversation moves on to the next candidate.
+        """
+        self.retry_policy.budget.record_request()
+        index = 0
+        upstream = candidates[0]
+        upstream.acquire()
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                breaker = self.breakers.get(f"{upstream.name}_chat_messages")
+                # An open circuit fails fast, without waiting for or spending a rate-limit token
+                probe = breaker.allow()
+                budget_name, deadline = budget.next()
+                try:
+                    # A cancelled wait returns its rate-limit reservation
+                    async with asyncio.timeout_at(deadline):
+                        await upstream.rate_limiter.acquire(estimated_tokens)
+                except TimeoutError:
+                    breaker.release(probe)
+                    raise budget.exceeded(budget_name) from None
+                except BaseException:
+                    breaker.release(probe)
+                    raise
+                metrics.inc("dify_attempts_total")
+                request = self.client.build_request(
+                    "POST",
+                    f"{upstream.base_url}/chat-messages",
+                    headers={
+                        "Authorization": f"Bearer {upstream.api_key}",
+                        "Content-Type": "application/json",
+                        "Accept": "text/event-stream"
+                    },
+                    json=payload,
+                    timeout=self.http_timeout
+                )
+                budget_name, deadline = budget.next()
+                started = time.monotonic()
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        response = await self.client.send(request, stream=True)
+                except TimeoutError:
+                    self._record_timeout(breaker, probe, budget_name, time.monotonic() - started)
+                    raise budget.exceeded(budget_name) from None
+                except httpx.TransportError as e:
+                    breaker.record(probe, True, time.monotonic() - started)
+                    # A request that may have reached Dify is only resent for a new
+                    # conversation, where a duplicate leaves an orphan rather than
+                    # a repeated turn in the caller's history
+                    if payload["conversation_id"] and not isinstance(e, RETRYABLE_TRANSPORT_ERRORS):
+                        raise
+                    delay = self.retry_policy.backoff(attempt)
+                    if delay >= budget.remaining() or not self.retry_policy.should_retry(attempt, "transport_error"):
+                        raise
+                    logger.warning("Dify request to %s failed (%r); retrying in %.2fs", upstream.name, e, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                except BaseException:
+                    breaker.release(probe)
+                    raise
+                ttfb = time.monotonic() - started
+
+                if response.status_code == 404 and index + 1 < len(candidates):
+                    # The conversation was created on another upstream
+                    breaker.record(probe, False, ttfb)
+                    await response.aclose()
+                    upstream.release()
+                    index += 1
+                    upstream = candidates[index]
+                    upstream.acquire()
+                    continue
+
+                pause = upstream.rate_limiter.observe(response.status_code, response.headers)
+                if response.status_code == 429:
+                    # Rate limiting says nothing about upstream health
+                    breaker.release(probe)
+                elif response.status_code >= 500:
+                    breaker.record(probe, True, ttfb)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    break
+                if response.status_code == 429:
+                    # The rate limiter now holds every caller back for ``pause``
+                    delay, wait = 0.0, pause
+                else:
+                    delay = wait = max(self.retry_policy.backoff(attempt), parse_retry_after(response.headers) or 0.0)
+                if wait >= budget.remaining() or not self.retry_policy.should_retry(
+                    attempt, f"status_{response.status_code}"
+                ):
+                    if response.status_code == 429:
+                        await response.aclose()
+                        raise UpstreamRateLimited(math.ceil(pause or upstream.rate_limiter.default_retry_after))
+                    # Reported by the caller like any other error response
+                    break
+                await response.aclose()
+                logger.warning("Dify %s returned %d; retrying in %.2fs", upstream.name, response.status_code, delay)
+                if delay:
+                    await asyncio.sleep(delay)
+
+            if attempt > 1 and response.is_success:
+                metrics.inc("dify_retry_recovered_total")
+            # Successful (and 4xx) calls are judged once the body has been consumed
+            pending = response.status_code < 500 and response.status_code != 429
+            try:
+                yield upstream, response
+            except (httpx.TransportError, DifyStreamError):
+                if pending:
+                    breaker.record(probe, True, ttfb)
+                raise
+            except DifyTimeoutError as e:
+                if pending:
+                    self._record_timeout(breaker, probe, e.budget, ttfb)
+                raise
+            except BaseException:
+                if pending:
+                    breaker.release(probe)
+                raise
+            else:
+                if pending:
+                    breaker.record(probe, False, ttfb)
+            finally:
+                await response.aclose()
+        finally:
+            upstream.release()
+
+    @staticmethod
+    def _record_timeout(breaker, probe: bool, budget_name: str, duration: float):
+        # Running out of the caller's own deadline says nothing about Dify's health
+        if budget_name == "client_deadline":
+            breaker.release(probe)
+        else:
+            breaker.record(probe, True, duration)
+
+    async def stop_generation(self, task_id: str, upstream: Upstream) -> None:
+        breaker = self.breakers.get(f"{upstream.name}_chat_messages_stop")
+        try:
+            probe = breaker.allow()
+        except CircuitOpenError:
+            metrics.inc("dify_stop_failures_total")
+            logger.warning("Not stopping Dify task %s: circuit open", task_id)
+            return
+
+        started = time.monotonic()
+        try:
+            response = await self.client.post(
+                f"{upstream.base_url}/chat-messages/{task_id}/stop",
+                headers={"Authorization": f"Bearer {upstream.api_key}"},
+                json={"user": self.user},
+                timeout=5.0
+            )
+            response.raise_for_status()
+            breaker.record(probe, False, time.monotonic() - started)
+            metrics.inc("dify_stop_requests_total")
+        except httpx.HTTPError as e:
+            failed = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code >= 500
+            breaker.record(probe, failed, time.monotonic() - started)
+            metrics.inc("dify_stop_failures_total")
+            logger.warning("Failed to stop Dify task %s: %s", task_id, e)
+        except BaseException:
+            breaker.release(probe)
+            raise
+
+    def _stop_in_background(self, task_id: str, upstream: Upstream):
+        # Runs outside the cancelled task so the stop call itself is not cancelled
+        self._run_in_background(self.stop_generation(task_id, upstream))
+
+    def _run_in_background(self, coro: Coroutine):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
@@ -0,0 +1,72 @@
+import math
+import os
+from collections import deque
+from typing import Deque, Optional
+
+from .metrics import metrics
+
+class Hedger:
+    """Decides when to send a backup request for a slow first answer delta.
+
+    The hedge delay is the ``percentile`` of recently observed
+    time-to-first-event, clamped to ``[min_delay, max_delay]``
+    (``default_delay`` until ``min_samples`` have been seen). Hedges are capped
+    at ``max_ratio`` of requests: each request earns that fraction of a hedge,
+    with ``burst`` hedges of headroom.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        min_delay: float = 0.5,
+        max_delay: float = 10.0,
+        default_delay: float = 2.0,
+        max_ratio: float = 0.1,
+        burst: float = 5,
+        window: int = 200,
+        min_samples: int = 20
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._tokens = burst
+
+    def delay(self) -> float:
+        if len(self._samples) < self.min_samples:
+            return self.default_delay
+        ordered = sorted(self._samples)
+        value = ordered[min(math.ceil(self.percentile * len(ordered)) - 1, len(ordered) - 1)]
+        delay = min(max(value, self.min_delay), self.max_delay)
+        metrics.set("dify_hedge_delay_seconds", round(delay, 3))
+        return delay
+
+    def record_request(self):
+        self._tokens = min(self.burst, self._tokens + self.max_ratio)
+
+    def record_first_event(self, seconds: float):
+        self._samples.append(seconds)
+
+    def try_hedge(self) -> bool:
+        if self._tokens < 1:
+            metrics.inc("dify_hedges_suppressed_total")
+            return False
+        self._tokens -= 1
+        metrics.inc("dify_hedges_total")
+        return True
+
+def create_hedger() -> Optional[Hedger]:
+    if os.getenv("DIFY_HEDGING", "false").lower() not in ("1", "true", "yes"):
+        return None
+    return Hedger(
+        percentile=float(os.getenv("DIFY_HEDGE_PERCENTILE", "0.95")),
+        min_delay=float(os.getenv("DIFY_HEDGE_MIN_DELAY", "0.5")),
+        max_delay=float(os.getenv("DIFY_HEDGE_MAX_DELAY", "10")),
+        default_delay=float(os.getenv("DIFY_HEDGE_DEFAULT_DELAY", "2")),
+        max_ratio=float(os.getenv("DIFY_HEDGE_MAX_RATIO", "0.1")),
+        burst=float(os.getenv("DIFY_HEDGE_BURST", "5")),
+    )
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from .metrics import metrics
+
+class IdempotencyKeyConflict(Exception):
+    """The key was already used for a request with a different body."""
+
+class _Entry:
+    def __init__(self, fingerprint: str, future: asyncio.Future):
+        self.fingerprint = fingerprint
+        self.future = future
+        self.expires_at: Optional[float] = None
+
+def fingerprint(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+class IdempotencyStore:
+    """In-process store of idempotent request results.
+
+    The first request for a key runs the work; concurrent duplicates wait for
+    its result, and later duplicates get the stored result until it expires.
+    If the first request fails, nothing is stored and a waiting duplicate
+    runs the work itself.
+    """
+
+    def __init__(self, ttl: float = 86400, max_keys: int = 10000):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    async def run(
+        self, key: str, request_fingerprint: str, func: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """Return ``(result, replayed)`` for ``key``, running ``func`` at most once."""
+        while True:
+            entry = self._get(key)
+            if entry is None:
+                return await self._lead(key, request_fingerprint, func), False
+
+            if entry.fingerprint != request_fingerprint:
+                metrics.inc("idempotency_conflicts_total")
+                raise IdempotencyKeyConflict(key)
+
+            if entry.future.done():
+                metrics.inc("idempotency_replays_total")
+                return entry.future.result(), True
+
+            metrics.inc("idempotency_coalesced_total")
+            result = await asyncio.shield(entry.future)
+            if result is not None:
+                return result, True
+            # The original request failed; loop round and try to run it ourselves
+
+    async def _lead(self, key: str, request_fingerprint: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        entry = _Entry(request_fingerprint, asyncio.get_running_loop().create_future())
+        self._entries[key] = entry
+        try:
+            result = await func()
+        except BaseException:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+            entry.future.set_result(None)
+            raise
+
+        entry.future.set_result(result)
+        entry.expires_at = time.monotonic() + self.ttl
+        self._evict()
+        return result
+
+    def _get(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at is not None and entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def _evict(self):
+        excess = len(self._entries) - self.max_keys
+        if excess <= 0:
+            return
+        # Oldest completed keys go first; in-flight entries are never evicted
+        stale = []
+        for key, entry in self._entries.items():
+            if len(stale) == excess:
+                break
+            if entry.future.done():
+                stale.append(key)
+        for key in stale:
+            del self._entries[key]
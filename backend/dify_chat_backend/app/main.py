@@ -1,19 +1,38 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from fastapi.websockets import WebSocketState
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, desc
+from sqlalchemy import select, desc, literal, tuple_
 import uuid
+import json
+import base64
+import asyncio
+from contextlib import aclosing
 from datetime import datetime
-from typing import Optional, List
-from pydantic import BaseModel
+from typing import Optional, List, Dict, Tuple, AsyncGenerator
+from pydantic import BaseModel, ValidationError
 import os
-import httpx
+import logging
 from dotenv import load_dotenv
 
-from .database import init_db, async_session, Conversation
+# Load .env before importing modules that read settings at import time
+load_dotenv()
+
+from .database import init_db, async_session, get_engine_config, utcnow, Conversation
 from .dify_client import DifyClient
+from .metrics import metrics
+from .log_config import setup_logging, shutdown_logging
+from .persistence import create_writer, insert_conversations
+from .idempotency import IdempotencyStore, IdempotencyKeyConflict, fingerprint
+from .admission import UpstreamSaturated
+from .rate_limit import UpstreamRateLimited
+from .circuit_breaker import CircuitOpenError
+from .timeouts import DifyTimeoutError
 
-load_dotenv()
+setup_logging()
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -24,11 +43,35 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor", "X-Prev-Cursor", "Idempotent-Replayed", "X-Cache", "Retry-After", "X-Timeout-Budget"],
 )
 
 # Initialize Dify client
 dify_client = DifyClient()
 
+# How often a non-streaming request checks whether its client is still connected
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# Chat transcripts are written in batches by a background task; history can
+# lag a response by up to PERSISTENCE_FLUSH_INTERVAL seconds.
+WRITE_BEHIND_ENABLED = os.getenv("PERSISTENCE_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+conversation_writer = create_writer()
+
+# Idempotency-Key results are replayed for IDEMPOTENCY_TTL seconds
+idempotency_store = IdempotencyStore(
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", "86400")),
+    max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+)
+
+# Upper bound for /api/chat/history page sizes, whatever the client asks for
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", "200"))
+
+# nginx-style status for "client closed request"; never seen by the client
+CLIENT_CLOSED_REQUEST = 499
+
+class ClientDisconnected(Exception):
+    pass
+
 # Dependency to get database session
 async def get_db():
     async with async_session() as session:
@@ -50,68 +93,356 @@ class ConversationResponse(BaseModel):
     timestamp: datetime
     conversation_id: str
 
+async def save_conversation(
+    user_message: str,
+    assistant_message: str,
+    conversation_id: Optional[str]
+) -> Conversation:
+    conversation = Conversation(
+        id=str(uuid.uuid4()),
+        user_message=user_message,
+        assistant_message=assistant_message,
+        conversation_id=conversation_id or str(uuid.uuid4()),
+        timestamp=utcnow()
+    )
+
+    # All values are set above, so the response never waits for the write
+    # when write-behind persistence is running.
+    if conversation_writer.running:
+        await conversation_writer.put(conversation)
+        return conversation
+
+    await insert_conversations([conversation])
+    return conversation
+
+async def run_until_disconnect(http_request: Request, coro):
+    """Await ``coro``, cancelling it as soon as the HTTP client disconnects."""
+    task = asyncio.create_task(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                metrics.inc("chat_client_disconnects_total")
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+def bypasses_cache(cache_control: Optional[str]) -> bool:
+    """``Cache-Control: no-cache`` (or ``no-store``) skips the response cache lookup."""
+    if not cache_control:
+        return False
+    directives = {d.strip().lower() for d in cache_control.split(",")}
+    return bool(directives & {"no-cache", "no-store"})
+
+def format_sse(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 @app.on_event("startup")
 async def startup_event():
     await init_db()
+    await dify_client.start()
+    if WRITE_BEHIND_ENABLED:
+        await conversation_writer.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await dify_client.close()
+    await conversation_writer.close()
+    shutdown_logging()
 
 @app.get("/healthz")
 async def healthz():
     return {"status": "ok"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+@app.get("/api/diagnostics/database")
+async def get_database_diagnostics():
+    return get_engine_config()
+
+async def complete_chat(
+    request: ChatRequest,
+    http_request: Request,
+    response: Response,
+    use_cache: bool = True,
+    timeout: Optional[float] = None
+) -> ChatResponse:
+    logger.debug("Received chat request", extra={"conversation_id": request.conversation_id})
+    
+    # Call Dify API with streaming mode
+    dify_response = await run_until_disconnect(
+        http_request,
+        dify_client.chat(
+            message=request.message,
+            conversation_id=request.conversation_id,
+            use_cache=use_cache,
+            timeout=timeout
+        )
+    )
+    logger.debug("Dify API response received", extra={"conversation_id": dify_response["conversation_id"]})
+    caching = dify_client.response_cache is not None or dify_client.semantic_cache is not None
+    if caching and not request.conversation_id:
+        if not use_cache:
+            response.headers["X-Cache"] = "BYPASS"
+        else:
+            response.headers["X-Cache"] = "HIT" if dify_response["cached"] else "MISS"
+
+    # Create new conversation record
+    conversation = await save_conversation(
+        user_message=request.message,
+        assistant_message=dify_response["answer"],
+        conversation_id=dify_response["conversation_id"]
+    )
+
+    logger.debug("Created conversation record", extra={"record_id": conversation.id})
+    return ChatResponse(
+        conversation_id=conversation.conversation_id,
+        message=conversation.assistant_message,
+        timestamp=conversation.timestamp
+    )
+
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
-    db: AsyncSession = Depends(get_db)
+    http_request: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    cache_control: Optional[str] = Header(None),
+    x_request_timeout: Optional[float] = Header(None, gt=0)
 ):
+    use_cache = not bypasses_cache(cache_control)
     try:
-        print(f"Received chat request: {request}")
-        
-        # Call Dify API with streaming mode
-        dify_response = await dify_client.chat(
-            message=request.message,
-            conversation_id=request.conversation_id
-        )
-        print(f"Dify API Response: {dify_response}")
-
-        # Create new conversation record
-        conversation = Conversation(
-            id=str(uuid.uuid4()),
-            user_message=request.message,
-            assistant_message=dify_response["answer"],
-            conversation_id=dify_response["conversation_id"] or str(uuid.uuid4()),
-            timestamp=datetime.utcnow()
-        )
+        if not idempotency_key:
+            return await complete_chat(request, http_request, response, use_cache, x_request_timeout)
 
-        db.add(conversation)
-        await db.commit()
-        await db.refresh(conversation)
-
-        print(f"Created conversation record: {conversation.id}")
-        return ChatResponse(
-            conversation_id=conversation.conversation_id,
-            message=conversation.assistant_message,
-            timestamp=conversation.timestamp
+        # Retries with the same key share one Dify generation and one stored row
+        result, replayed = await idempotency_store.run(
+            idempotency_key,
+            fingerprint(request.model_dump()),
+            lambda: complete_chat(request, http_request, response, use_cache, x_request_timeout)
         )
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return result
+    except ClientDisconnected:
+        logger.info("Client disconnected before the chat response was ready")
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    except IdempotencyKeyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request body")
+    except (UpstreamSaturated, CircuitOpenError) as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except UpstreamRateLimited as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except DifyTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e), headers={"X-Timeout-Budget": e.budget})
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
-        if isinstance(e, httpx.HTTPError):
-            print(f"HTTP Error response: {e.response.content if hasattr(e, 'response') else 'No response content'}")
+        logger.exception("Error in chat endpoint")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def relay_chat(request: ChatRequest, use_cache: bool = True) -> AsyncGenerator[dict, None]:
+    """Relay Dify deltas for one chat turn, then store it and yield a final ``message_end``."""
+    answer_parts = []
+    conversation_id = request.conversation_id
+    async with aclosing(dify_client.chat_stream(
+        message=request.message,
+        conversation_id=request.conversation_id,
+        use_cache=use_cache
+    )) as events:
+        async for event in events:
+            conversation_id = event["conversation_id"]
+            if event["event"] == "message":
+                answer_parts.append(event["answer"])
+                yield event
+
+    conversation = await save_conversation(
+        user_message=request.message,
+        assistant_message="".join(answer_parts).strip(),
+        conversation_id=conversation_id
+    )
+
+    response = ChatResponse(
+        conversation_id=conversation.conversation_id,
+        message=conversation.assistant_message,
+        timestamp=conversation.timestamp
+    )
+    yield {"event": "message_end", **response.model_dump(mode="json")}
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest, cache_control: Optional[str] = Header(None)):
+    use_cache = not bypasses_cache(cache_control)
+    logger.debug("Received streaming chat request", extra={"conversation_id": request.conversation_id})
+
+    # StreamingResponse cancels this generator when the client disconnects,
+    # which unwinds relay_chat and aborts the upstream Dify stream.
+    async def event_stream():
+        try:
+            async with aclosing(relay_chat(request, use_cache)) as events:
+                async for event in events:
+                    yield format_sse(event)
+        except (asyncio.CancelledError, GeneratorExit):
+            metrics.inc("chat_client_disconnects_total")
+            raise
+        except (UpstreamSaturated, UpstreamRateLimited, CircuitOpenError) as e:
+            yield format_sse({"event": "error", "detail": str(e), "retry_after": e.retry_after})
+        except DifyTimeoutError as e:
+            yield format_sse({"event": "error", "detail": str(e), "budget": e.budget})
+        except Exception as e:
+            logger.exception("Error in chat stream endpoint")
+            yield format_sse({"event": "error", "detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/api/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def send(frame: dict):
+        async with send_lock:
+            await websocket.send_json(frame)
+
+    async def run_chat(request_id: str, request: ChatRequest, use_cache: bool):
+        try:
+            async with aclosing(relay_chat(request, use_cache)) as events:
+                async for event in events:
+                    await send({"request_id": request_id, **event})
+        except asyncio.CancelledError:
+            metrics.inc("chat_websocket_cancellations_total")
+            if websocket.client_state == WebSocketState.CONNECTED:
+                await send({"request_id": request_id, "event": "cancelled"})
+            raise
+        except (UpstreamSaturated, UpstreamRateLimited, CircuitOpenError) as e:
+            await send({"request_id": request_id, "event": "error", "detail": str(e), "retry_after": e.retry_after})
+        except DifyTimeoutError as e:
+            await send({"request_id": request_id, "event": "error", "detail": str(e), "budget": e.budget})
+        except Exception as e:
+            logger.exception("Error in chat websocket request %s", request_id)
+            await send({"request_id": request_id, "event": "error", "detail": str(e)})
+        finally:
+            tasks.pop(request_id, None)
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            # A malformed frame is answered with an error, not by closing the socket
+            # (which would cancel every other request on it)
+            try:
+                frame = json.loads(message.get("text") or message.get("bytes") or "")
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                frame = None
+            if not isinstance(frame, dict):
+                await send({"request_id": None, "event": "error", "detail": "Frames must be JSON objects"})
+                continue
+            request_id = str(frame.get("request_id") or uuid.uuid4())
+            frame_type = frame.get("type", "chat")
+
+            if frame_type == "cancel":
+                task = tasks.get(request_id)
+                if task:
+                    task.cancel()
+                continue
+
+            if frame_type != "chat":
+                await send({"request_id": request_id, "event": "error", "detail": f"Unknown frame type: {frame_type}"})
+                continue
+            if request_id in tasks:
+                await send({"request_id": request_id, "event": "error", "detail": "request_id already in progress"})
+                continue
+
+            try:
+                request = ChatRequest.model_validate(frame)
+            except ValidationError as e:
+                await send({"request_id": request_id, "event": "error", "detail": str(e)})
+                continue
+
+            # Frames cannot carry headers; {"cache": false} bypasses the response cache
+            use_cache = frame.get("cache", True) is not False
+            tasks[request_id] = asyncio.create_task(run_chat(request_id, request, use_cache))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        pending = list(tasks.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+def encode_history_cursor(conversation: Conversation, direction: str) -> str:
+    raw = json.dumps({"t": conversation.timestamp.isoformat(), "i": conversation.id, "d": direction})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        direction = data["d"]
+        if direction not in ("older", "newer"):
+            raise ValueError(direction)
+        return datetime.fromisoformat(data["t"]), str(uuid.UUID(data["i"])), direction
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
 @app.get("/api/chat/history", response_model=List[ConversationResponse])
 async def get_chat_history(
-    limit: int = 50,
+    response: Response,
+    limit: int = Query(50, ge=1),
     before: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    conversation_id: Optional[uuid.UUID] = None,
     db: AsyncSession = Depends(get_db)
 ):
+    # Keyset pagination on (timestamp, id): every page is an index range scan,
+    # however deep the client pages, and rows sharing a timestamp are never skipped.
+    limit = min(limit, HISTORY_MAX_LIMIT)
+    position = decode_history_cursor(cursor) if cursor else None
+
     try:
         stmt = select(Conversation)
+        if conversation_id:
+            stmt = stmt.where(Conversation.conversation_id == str(conversation_id))
         if before:
             stmt = stmt.where(Conversation.timestamp < before)
-        stmt = stmt.order_by(desc(Conversation.timestamp)).limit(limit)
+
+        key = tuple_(Conversation.timestamp, Conversation.id)
+        newer = position is not None and position[2] == "newer"
+        if position:
+            boundary = tuple_(
+                literal(position[0], Conversation.timestamp.type),
+                literal(position[1], Conversation.id.type)
+            )
+            stmt = stmt.where(key > boundary if newer else key < boundary)
+        if newer:
+            stmt = stmt.order_by(Conversation.timestamp, Conversation.id)
+        else:
+            stmt = stmt.order_by(desc(Conversation.timestamp), desc(Conversation.id))
+        stmt = stmt.limit(limit)
         
         result = await db.execute(stmt)
-        conversations = result.scalars().all()
+        conversations = list(result.scalars().all())
+        if newer:
+            conversations.reverse()
+
+        # Pages are always newest-first; X-Next-Cursor walks back in time and
+        # X-Prev-Cursor walks forward to rows newer than this page.
+        if conversations:
+            if len(conversations) == limit or newer:
+                response.headers["X-Next-Cursor"] = encode_history_cursor(conversations[-1], "older")
+            response.headers["X-Prev-Cursor"] = encode_history_cursor(conversations[0], "newer")
         
         return [
             ConversationResponse(
@@ -0,0 +1,23 @@
+from collections import defaultdict
+from typing import Dict, Union
+
+Number = Union[int, float]
+
+class Metrics:
+    def __init__(self):
+        self._counters: Dict[str, Number] = defaultdict(int)
+        self._gauges: Dict[str, Number] = {}
+
+    def inc(self, name: str, value: Number = 1) -> None:
+        self._counters[name] += value
+
+    def set(self, name: str, value: Number) -> None:
+        self._gauges[name] = value
+
+    def snapshot(self) -> Dict[str, Dict[str, Number]]:
+        return {
+            "counters": dict(self._counters),
+            "gauges": dict(self._gauges),
+        }
+
+metrics = Metrics()
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from sqlalchemy import insert
+
+from .database import async_session, Conversation
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class WriteBehindQueue:
+    """Buffers Conversation rows in memory and inserts them in batches.
+
+    Rows are flushed with one multi-row INSERT once ``max_batch_size`` rows are
+    waiting or ``flush_interval`` seconds after the first row of a batch arrived.
+    ``put`` blocks while ``max_queue_size`` rows are pending, so a slow database
+    pushes back on request handlers instead of growing memory without bound.
+
+    A failed batch (e.g. SQLite busy, a PostgreSQL failover) is retried up to
+    ``max_retries`` times with exponential backoff from ``retry_delay`` capped at
+    ``max_retry_delay``; after that its rows are inserted one at a time, so only
+    rows that fail on their own are lost.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = 100,
+        flush_interval: float = 0.05,
+        max_queue_size: int = 10000,
+        max_retries: int = 3,
+        retry_delay: float = 0.1,
+        max_retry_delay: float = 2.0
+    ):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Flush everything still queued, then stop the writer task."""
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        metrics.set("persistence_queue_depth", 0)
+
+    async def put(self, conversation: Conversation):
+        if self._queue.full():
+            metrics.inc("persistence_backpressure_total")
+        await self._queue.put(conversation)
+        metrics.set("persistence_queue_depth", self._queue.qsize())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            metrics.set("persistence_queue_depth", self._queue.qsize())
+
+    async def _flush(self, batch: List[Conversation]):
+        attempt = 0
+        while True:
+            try:
+                await insert_conversations(batch)
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    logger.warning("Failed to write %d conversation rows (%r); writing them one by one", len(batch), e)
+                    break
+                delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+                attempt += 1
+                metrics.inc("persistence_batch_retries_total")
+                logger.warning("Failed to write %d conversation rows (%r); retrying in %.2fs", len(batch), e, delay)
+                await asyncio.sleep(delay)
+                continue
+            metrics.inc("persistence_batches_total")
+            metrics.inc("persistence_rows_written_total", len(batch))
+            return
+
+        # The batch is one transaction, so none of it was written
+        for conversation in batch:
+            try:
+                await insert_conversations([conversation])
+                metrics.inc("persistence_rows_written_total")
+            except Exception:
+                metrics.inc("persistence_failed_rows_total")
+                logger.exception("Failed to write conversation row %s", conversation.id)
+
+async def insert_conversations(conversations: List[Conversation]):
+    """Insert fully populated rows with a single INSERT statement.
+
+    Every column is set in Python before the insert, so nothing needs to be read
+    back afterwards (no RETURNING, no refresh).
+    """
+    columns = Conversation.__table__.columns
+    rows = [{column.name: getattr(conversation, column.name) for column in columns} for conversation in conversations]
+    async with async_session() as session:
+        await session.execute(insert(Conversation).values(rows))
+        await session.commit()
+
+def create_writer() -> WriteBehindQueue:
+    return WriteBehindQueue(
+        max_batch_size=int(os.getenv("PERSISTENCE_BATCH_SIZE", "100")),
+        flush_interval=float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "0.05")),
+        max_queue_size=int(os.getenv("PERSISTENCE_MAX_QUEUE_SIZE", "10000")),
+        max_retries=int(os.getenv("PERSISTENCE_MAX_RETRIES", "3")),
+        retry_delay=float(os.getenv("PERSISTENCE_RETRY_DELAY", "0.1")),
+        max_retry_delay=float(os.getenv("PERSISTENCE_MAX_RETRY_DELAY", "2")),
+    )
@@ -0,0 +1,169 @@
+import asyncio
+import math
+import os
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+from .metrics import metrics
+
+class UpstreamRateLimited(Exception):
+    """Dify is rate limiting us and the wait would exceed what a caller should sit through."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Dify rate limit reached; retry after {retry_after}s")
+        self.retry_after = retry_after
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait according to ``Retry-After`` or a ``*RateLimit-Reset`` header."""
+    value = headers.get("retry-after")
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            when = None
+        if when is not None:
+            return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+    for name in ("ratelimit-reset", "x-ratelimit-reset"):
+        value = headers.get(name)
+        if value:
+            try:
+                reset = float(value)
+            except ValueError:
+                continue
+            # Some APIs send an epoch timestamp rather than a delay
+            return max(reset - time.time(), 0.0) if reset > 1e9 else reset
+    return None
+
+class TokenBucket:
+    """Token bucket where callers reserve tokens up front and then sleep off any debt.
+
+    Reservations may drive the balance negative, so concurrent callers are
+    spaced out in arrival order without a lock.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.rate = rate
+
+    def reserve(self, amount: float) -> float:
+        """Take ``amount`` tokens and return how many seconds the caller must wait."""
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return max(-self.tokens / self.rate, 0.0)
+
+    def refund(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+class RateLimiter:
+    """Client-side limit on Dify calls, shared by every coroutine in the process.
+
+    Spaces requests with a requests-per-second bucket and, optionally, an
+    LLM tokens-per-minute bucket (charged with an estimate up front and
+    corrected once Dify reports usage). A 429 or an exhausted rate-limit
+    header pauses all callers until the upstream reset time and halves the
+    request rate; each successful call wins back a little of it. Callers
+    that would wait longer than ``max_wait`` get :class:`UpstreamRateLimited`.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float = 0,
+        burst: Optional[float] = None,
+        tokens_per_minute: float = 0,
+        max_wait: float = 10.0,
+        default_retry_after: float = 1.0
+    ):
+        self.base_rate = requests_per_second
+        self.requests = TokenBucket(requests_per_second, burst or max(requests_per_second, 1)) if requests_per_second > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_wait = max_wait
+        self.default_retry_after = default_retry_after
+        self.rate_factor = 1.0
+        self._paused_until = 0.0
+
+    async def acquire(self, estimated_tokens: int = 0):
+        wait = max(self._paused_until - time.monotonic(), 0.0)
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None and estimated_tokens:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+
+        if wait > self.max_wait:
+            self._refund(estimated_tokens)
+            metrics.inc("dify_rate_limit_rejected_total")
+            raise UpstreamRateLimited(math.ceil(wait))
+        if wait > 0:
+            metrics.inc("dify_rate_limit_delayed_total")
+            metrics.inc("dify_rate_limit_wait_seconds_total", wait)
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self._refund(estimated_tokens)
+                raise
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        if self.tokens is not None:
+            # Positive differences become debt that later callers wait off
+            self.tokens.tokens -= actual_tokens - estimated_tokens
+
+    def observe(self, status_code: int, headers: Mapping[str, str]) -> Optional[float]:
+        """Adapt to an upstream response; returns the pause applied, if any."""
+        remaining = headers.get("x-ratelimit-remaining") or headers.get("ratelimit-remaining")
+        if status_code != 429 and remaining != "0":
+            if self.rate_factor < 1.0:
+                self._set_rate_factor(self.rate_factor + 0.05)
+            return None
+
+        pause = parse_retry_after(headers)
+        if pause is None:
+            if status_code != 429:
+                return None
+            pause = self.default_retry_after
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        if status_code == 429:
+            metrics.inc("dify_rate_limited_total")
+            self._set_rate_factor(self.rate_factor / 2)
+        metrics.set("dify_rate_limit_paused_seconds", round(pause, 3))
+        return pause
+
+    def _set_rate_factor(self, factor: float):
+        self.rate_factor = min(max(factor, 0.1), 1.0)
+        if self.requests is not None:
+            self.requests.set_rate(self.base_rate * self.rate_factor)
+        metrics.set("dify_rate_limit_rate_factor", round(self.rate_factor, 3))
+
+    def _refund(self, estimated_tokens: int):
+        if self.requests is not None:
+            self.requests.refund(1)
+        if self.tokens is not None and estimated_tokens:
+            self.tokens.refund(estimated_tokens)
+
+def estimate_tokens(text: str) -> int:
+    # Rough prompt size; corrected with Dify's reported usage afterwards
+    return max(len(text) // 4, 1)
+
+def create_rate_limiter() -> RateLimiter:
+    burst = os.getenv("DIFY_RATE_LIMIT_BURST")
+    return RateLimiter(
+        requests_per_second=float(os.getenv("DIFY_RATE_LIMIT_RPS", "0")),
+        burst=float(burst) if burst else None,
+        tokens_per_minute=float(os.getenv("DIFY_RATE_LIMIT_TPM", "0")),
+        max_wait=float(os.getenv("DIFY_RATE_LIMIT_MAX_WAIT", "10")),
+    )
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Protocol, Tuple
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CachedResponse = Dict[str, str]
+
+def cache_key(message: str) -> str:
+    # Exact match: the message bytes as sent, no normalisation
+    return hashlib.sha256(message.encode()).hexdigest()
+
+class CacheStore(Protocol):
+    """Second-tier storage consulted when the in-process LRU misses."""
+
+    async def get(self, key: str) -> Optional[Tuple[CachedResponse, float]]:
+        """Return ``(value, expires_at)`` with ``expires_at`` in wall-clock seconds."""
+
+    async def set(self, key: str, value: CachedResponse, expires_at: float) -> None:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+class SQLiteCacheStore:
+    """Keeps cached responses in a local SQLite file so they survive restarts.
+
+    Uses the stdlib driver in a worker thread; expiry times are wall-clock
+    seconds. Rows beyond ``max_entries`` are pruned oldest-first every
+    ``prune_every`` writes. Metrics are not thread-safe, so the worker reports
+    what it expired or evicted and the event loop counts it.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000, prune_every: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_stored_at ON response_cache (stored_at)")
+
+    async def get(self, key: str) -> Optional[Tuple[CachedResponse, float]]:
+        stored, expired = await asyncio.to_thread(self._get, key)
+        if expired:
+            metrics.inc("response_cache_expired_total")
+        return stored
+
+    async def set(self, key: str, value: CachedResponse, expires_at: float) -> None:
+        evicted = await asyncio.to_thread(self._set, key, value, expires_at)
+        if evicted:
+            metrics.inc("response_cache_evictions_total", evicted)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _get(self, key: str) -> Tuple[Optional[Tuple[CachedResponse, float]], bool]:
+        """Return ``(value and expiry, or None; whether an expired row was dropped)``."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None, False
+            if row[1] <= time.time():
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None, True
+            return (json.loads(row[0]), row[1]), False
+
+    def _set(self, key: str, value: CachedResponse, expires_at: float) -> int:
+        """Store a row; returns how many rows pruning evicted."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, stored_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, time.time())
+            )
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                return self._prune()
+            return 0
+
+    def _prune(self) -> int:
+        self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+        cursor = self._conn.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            "SELECT key FROM response_cache ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        return max(cursor.rowcount, 0)
+
+class ResponseCache:
+    """Exact-match cache of complete answers to first-turn messages.
+
+    Lookups hit an in-process LRU bounded by ``max_entries`` and ``ttl``
+    seconds; on a miss the optional ``store`` is consulted and a hit there is
+    promoted into memory. Writes go to both tiers.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, store: Optional[CacheStore] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        # key -> (monotonic expiry, value)
+        self._entries: "OrderedDict[str, Tuple[float, CachedResponse]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                metrics.inc("response_cache_hits_total")
+                return entry[1]
+            del self._entries[key]
+            metrics.inc("response_cache_expired_total")
+
+        if self.store is not None:
+            try:
+                stored = await self.store.get(key)
+            except Exception:
+                logger.exception("Response cache store lookup failed")
+                stored = None
+            if stored is not None:
+                value, expires_at = stored
+                metrics.inc("response_cache_hits_total")
+                metrics.inc("response_cache_store_hits_total")
+                self._remember(key, value, expires_at - time.time())
+                return value
+
+        metrics.inc("response_cache_misses_total")
+        return None
+
+    async def set(self, key: str, value: CachedResponse):
+        self._remember(key, value, self.ttl)
+        metrics.inc("response_cache_stores_total")
+        if self.store is not None:
+            try:
+                await self.store.set(key, value, time.time() + self.ttl)
+            except Exception:
+                logger.exception("Response cache store write failed")
+
+    async def close(self):
+        if self.store is not None:
+            await self.store.close()
+
+    def _remember(self, key: str, value: CachedResponse, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            metrics.inc("response_cache_evictions_total")
+        metrics.set("response_cache_entries", len(self._entries))
+
+def create_response_cache() -> Optional[ResponseCache]:
+    if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return None
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+    store = None
+    path = os.getenv("RESPONSE_CACHE_SQLITE_PATH")
+    if path:
+        store = SQLiteCacheStore(path, max_entries=int(os.getenv("RESPONSE_CACHE_SQLITE_MAX_ENTRIES", "100000")))
+    return ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+        ttl=ttl,
+        store=store,
+    )
@@ -0,0 +1,67 @@
+import os
+import random
+
+import httpx
+
+from .metrics import metrics
+
+# Statuses where Dify has not started generating, so sending again is safe
+RETRYABLE_STATUS_CODES = frozenset({429, 502, 503, 504})
+# Transport errors raised before the request reached Dify. Read-side errors
+# (ReadTimeout, ReadError, RemoteProtocolError) may come after Dify accepted it.
+RETRYABLE_TRANSPORT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class RetryBudget:
+    """Caps retries at a fraction of traffic so an outage cannot multiply load.
+
+    Every request deposits ``ratio`` tokens (up to ``max_tokens``) and every
+    retry spends a whole one, so in steady state at most ``ratio`` retries
+    are sent per request, with ``max_tokens`` of headroom for short blips.
+    """
+
+    def __init__(self, ratio: float = 0.2, max_tokens: float = 10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def record_request(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            metrics.inc("dify_retry_budget_exhausted_total")
+            return False
+        self.tokens -= 1
+        metrics.set("dify_retry_budget_tokens", round(self.tokens, 2))
+        return True
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts and a shared budget."""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 5.0, budget: RetryBudget = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+
+    def should_retry(self, attempt: int, reason: str) -> bool:
+        """``attempt`` is the number of attempts made so far."""
+        metrics.inc(f"dify_attempt_failures_{reason}_total")
+        if attempt >= self.max_attempts or not self.budget.try_spend():
+            return False
+        metrics.inc("dify_retries_total")
+        return True
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+def create_retry_policy() -> RetryPolicy:
+    return RetryPolicy(
+        max_attempts=int(os.getenv("DIFY_RETRY_MAX_ATTEMPTS", "3")),
+        base_delay=float(os.getenv("DIFY_RETRY_BASE_DELAY", "0.2")),
+        max_delay=float(os.getenv("DIFY_RETRY_MAX_DELAY", "5")),
+        budget=RetryBudget(
+            ratio=float(os.getenv("DIFY_RETRY_BUDGET_RATIO", "0.2")),
+            max_tokens=float(os.getenv("DIFY_RETRY_BUDGET_MAX", "10")),
+        ),
+    )
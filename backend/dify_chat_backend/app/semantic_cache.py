@@ -0,0 +1,227 @@
+import importlib
+import json
+import logging
+import math
+import os
+import re
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Protocol, Sequence, Tuple, Union
+
+import numpy as np
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SparseVector = Dict[int, float]
+# Sparse ``{dimension: weight}`` or a dense sequence of ``dim`` floats
+Vector = Union[SparseVector, Sequence[float]]
+CachedResponse = Dict[str, str]
+
+_WORD_RE = re.compile(r"\w+")
+
+class Embedder(Protocol):
+    dim: int
+
+    def embed(self, text: str) -> Vector:
+        """Return the embedding of ``text``; the cache L2-normalises it."""
+
+class HashingEmbedder:
+    """Offline embedder: hashed word and character-trigram counts.
+
+    Words catch reordered or partly reworded questions; character trigrams
+    catch inflections, typos and scripts without spaces (e.g. Japanese).
+    Counts are log-scaled (sublinear TF) and hashed into ``dim`` signed buckets.
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def embed(self, text: str) -> SparseVector:
+        words = _WORD_RE.findall(text.lower())
+        joined = " ".join(words)
+        features = ["w:" + word for word in words]
+        features.extend("c:" + joined[i:i + 3] for i in range(max(len(joined) - 2, 0)))
+
+        counts: Dict[int, float] = defaultdict(float)
+        for feature in features:
+            h = zlib.crc32(feature.encode())
+            counts[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+
+        weights = {i: math.copysign(1.0 + math.log(abs(c)), c) for i, c in counts.items() if c}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if not norm:
+            return {}
+        return {i: w / norm for i, w in weights.items()}
+
+class _Entry:
+    __slots__ = ("text", "value", "expires_at", "slot")
+
+    def __init__(self, text: str, value: CachedResponse, expires_at: float, slot: int):
+        self.text = text
+        self.value = value
+        self.expires_at = expires_at
+        self.slot = slot
+
+class SemanticCache:
+    """Answers paraphrases of earlier first-turn messages from a local vector index.
+
+    Every cached message is embedded into a fixed row of a brute-force NumPy
+    index; a lookup returns the most similar unexpired entry if its cosine
+    similarity is at least ``threshold``. The default hashing embedder is
+    lexical: it cannot tell "can I cancel" from "can I not cancel" in a long
+    message (about 0.97), so its 0.98 threshold only matches near-identical
+    text. Catching real paraphrases needs a semantic ``embedder`` (see
+    :func:`load_embedder`) with a threshold tuned for it. Entries are evicted
+    least-recently-used beyond ``max_entries``. With ``path`` set, entries are
+    saved as JSON on close and reloaded (and re-embedded) on startup.
+    """
+
+    def __init__(
+        self,
+        embedder: Optional[Embedder] = None,
+        threshold: float = 0.98,
+        max_entries: int = 1000,
+        ttl: float = 3600,
+        path: Optional[str] = None
+    ):
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        # message text -> entry, least recently used first
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_slot: List[Optional[_Entry]] = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self._matrix = np.zeros((max_entries, self.embedder.dim), dtype=np.float32)
+        # Expiry per slot; free slots never expire
+        self._expires = np.full(max_entries, np.inf)
+
+    def get(self, message: str) -> Optional[CachedResponse]:
+        self._remove_expired()
+        vector = self._embed(message)
+        if vector is None or not self._entries:
+            metrics.inc("semantic_cache_misses_total")
+            return None
+
+        entry, similarity = self._nearest(vector)
+        if entry is None or similarity < self.threshold:
+            metrics.inc("semantic_cache_misses_total")
+            return None
+
+        self._entries.move_to_end(entry.text)
+        metrics.inc("semantic_cache_hits_total")
+        metrics.set("semantic_cache_last_hit_similarity", round(similarity, 4))
+        return entry.value
+
+    def set(self, message: str, value: CachedResponse, expires_at: Optional[float] = None):
+        vector = self._embed(message)
+        if vector is None:
+            return
+        existing = self._entries.get(message)
+        if existing is not None:
+            self._remove(existing)
+        while not self._free_slots:
+            self._remove(next(iter(self._entries.values())))
+            metrics.inc("semantic_cache_evictions_total")
+
+        slot = self._free_slots.pop()
+        entry = _Entry(message, value, expires_at or time.time() + self.ttl, slot)
+        self._entries[message] = entry
+        self._by_slot[slot] = entry
+        self._matrix[slot] = vector
+        self._expires[slot] = entry.expires_at
+        metrics.inc("semantic_cache_stores_total")
+        metrics.set("semantic_cache_entries", len(self._entries))
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """The unit-length dense embedding of ``text``, or None if it is empty."""
+        vector = self.embedder.embed(text)
+        if isinstance(vector, dict):
+            dense = np.zeros(self.embedder.dim, dtype=np.float32)
+            for i, w in vector.items():
+                dense[i] = w
+        else:
+            dense = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(dense))
+        return dense / norm if norm else None
+
+    def _nearest(self, vector: np.ndarray) -> Tuple[Optional[_Entry], float]:
+        # Free slots are all-zero rows and score 0
+        scores = self._matrix @ vector
+        slot = int(scores.argmax())
+        return self._by_slot[slot], float(scores[slot])
+
+    def _remove_expired(self):
+        # Dropped before the search so an expired best match cannot hide a valid one
+        for slot in np.flatnonzero(self._expires <= time.time()):
+            self._remove(self._by_slot[slot])
+            metrics.inc("semantic_cache_expired_total")
+
+    def _remove(self, entry: _Entry):
+        del self._entries[entry.text]
+        self._by_slot[entry.slot] = None
+        self._matrix[entry.slot] = 0
+        self._expires[entry.slot] = np.inf
+        self._free_slots.append(entry.slot)
+        metrics.set("semantic_cache_entries", len(self._entries))
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            logger.exception("Could not load semantic cache from %s", self.path)
+            return
+        now = time.time()
+        for item in saved[-self.max_entries:]:
+            if item["expires_at"] > now:
+                self.set(item["text"], item["value"], item["expires_at"])
+        logger.info("Loaded %d semantic cache entries", len(self._entries))
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        saved = [
+            {"text": e.text, "value": e.value, "expires_at": e.expires_at}
+            for e in self._entries.values()
+            if e.expires_at > now
+        ]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(saved, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+def load_embedder(spec: str, dim: int = 1024) -> Embedder:
+    """``"hashing"`` for :class:`HashingEmbedder` with ``dim`` buckets, or
+    ``"package.module:name"`` for a zero-argument callable (e.g. a class
+    wrapping a sentence-embedding model) that returns an :class:`Embedder`.
+    """
+    if spec == "hashing":
+        return HashingEmbedder(dim=dim)
+    module_name, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError(f"SEMANTIC_CACHE_EMBEDDER must be 'hashing' or 'module:name', not {spec!r}")
+    return getattr(importlib.import_module(module_name), attribute)()
+
+def create_semantic_cache() -> Optional[SemanticCache]:
+    if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return None
+    cache = SemanticCache(
+        embedder=load_embedder(
+            os.getenv("SEMANTIC_CACHE_EMBEDDER", "hashing"),
+            dim=int(os.getenv("SEMANTIC_CACHE_DIM", "1024")),
+        ),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.98")),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000")),
+        ttl=float(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+        path=os.getenv("SEMANTIC_CACHE_PATH") or None,
+    )
+    cache.load()
+    return cache
@@ -0,0 +1,100 @@
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from .metrics import metrics
+
+def normalize_message(message: str) -> str:
+    return " ".join(message.split())
+
+class _Flight:
+    def __init__(self):
+        self.events: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self):
+        # Wake everyone waiting on the current event and start a fresh one
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+class SingleFlight:
+    """Shares one upstream event stream between concurrent callers with the same key.
+
+    The first caller for a key starts the upstream stream in a background task
+    (``factory`` is only called for it); callers arriving while it runs first
+    receive the events already seen, then follow along live. The upstream
+    stream is cancelled once every caller has gone away, and the key is
+    released as soon as the stream finishes.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+
+    async def stream(
+        self, key: str, factory: Callable[[], AsyncIterator[Any]], timeout: Optional[float] = None
+    ) -> AsyncIterator[Any]:
+        """Follow the shared stream for ``key``.
+
+        ``timeout`` bounds this caller only: it gets :class:`TimeoutError` once
+        that many seconds have passed, while the stream carries on for the rest.
+        """
+        deadline = asyncio.get_running_loop().time() + timeout if timeout is not None else None
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._pump(key, flight, factory))
+            metrics.inc("single_flight_leaders_total")
+        else:
+            metrics.inc("single_flight_followers_total")
+        metrics.set("single_flight_in_flight", len(self._flights))
+
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                changed = flight.changed
+                if index < len(flight.events):
+                    event = flight.events[index]
+                    index += 1
+                    yield event
+                    continue
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                async with asyncio.timeout_at(deadline):
+                    await changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Unlist the flight first so that no new caller joins one being torn down
+                self._release(key, flight)
+                flight.task.cancel()
+
+    async def _pump(self, key: str, flight: _Flight, factory: Callable[[], AsyncIterator[Any]]):
+        upstream = factory()
+        try:
+            async for event in upstream:
+                flight.events.append(event)
+                flight.publish()
+        except asyncio.CancelledError:
+            # Callers are only left when cancelled from outside (e.g. at shutdown);
+            # they must not take the truncated stream for a complete one
+            flight.error = RuntimeError("Shared upstream stream was cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            await upstream.aclose()
+            flight.done = True
+            self._release(key, flight)
+            flight.publish()
+
+    def _release(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        metrics.set("single_flight_in_flight", len(self._flights))
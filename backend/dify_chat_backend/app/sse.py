@@ -0,0 +1,93 @@
+from typing import AsyncIterator, List, NamedTuple, Optional
+
+class SSEEvent(NamedTuple):
+    event: str
+    data: str
+    id: Optional[str] = None
+
+class SSEParser:
+    """Incremental text/event-stream parser.
+
+    Text can be fed in arbitrary chunks (lines may be split anywhere); complete
+    events are returned as soon as their terminating blank line is seen.
+    """
+
+    def __init__(self):
+        self.last_event_id: Optional[str] = None
+        self.retry: Optional[int] = None
+        self._tail: List[str] = []
+        self._pending_cr = False
+        self._event = ""
+        self._data: List[str] = []
+
+    def feed(self, text: str) -> List[SSEEvent]:
+        if not text:
+            return []
+        if self._pending_cr and text[0] == "\n":
+            # Second half of a "\r\n" split across two chunks
+            text = text[1:]
+        if "\r" in text:
+            self._pending_cr = text[-1] == "\r"
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        else:
+            self._pending_cr = False
+
+        if "\n" not in text:
+            # No line completed yet; buffer without re-copying the partial line
+            self._tail.append(text)
+            return []
+        if self._tail:
+            self._tail.append(text)
+            text = "".join(self._tail)
+        lines = text.split("\n")
+        tail = lines.pop()
+        self._tail = [tail] if tail else []
+
+        events: List[SSEEvent] = []
+        data = self._data
+        for line in lines:
+            if not line:
+                if data:
+                    events.append(SSEEvent(self._event or "message", "\n".join(data), self.last_event_id))
+                    data = self._data = []
+                self._event = ""
+            elif line[:6] == "data: ":
+                data.append(line[6:])
+            else:
+                self._process_field(line)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """Dispatch whatever is buffered once the stream has ended."""
+        events = self.feed("\n\n") if self._tail else self.feed("\n")
+        self._tail = []
+        self._pending_cr = False
+        return events
+
+    def _process_field(self, line: str):
+        if line[0] == ":":
+            return  # comment / keep-alive
+
+        field, _, value = line.partition(":")
+        if value[:1] == " ":
+            value = value[1:]
+
+        if field == "event":
+            self._event = value
+        elif field == "id":
+            if "\0" not in value:
+                self.last_event_id = value
+        elif field == "retry":
+            if value.isdigit():
+                self.retry = int(value)
+        elif field == "data":
+            # "data:value" without the space, or a bare "data" line
+            self._data.append(value)
+
+async def aiter_events(chunks: AsyncIterator[str]) -> AsyncIterator[SSEEvent]:
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
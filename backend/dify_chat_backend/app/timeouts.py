@@ -0,0 +1,79 @@
+import asyncio
+import os
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from .metrics import metrics
+
+# Which budget an httpx timeout exception corresponds to
+HTTPX_TIMEOUT_BUDGETS = {
+    httpx.ConnectTimeout: "connect",
+    httpx.ReadTimeout: "idle",
+    httpx.WriteTimeout: "write",
+    httpx.PoolTimeout: "pool",
+}
+
+class DifyTimeoutError(Exception):
+    """A Dify call ran out of one of its time budgets; ``budget`` names which."""
+
+    def __init__(self, budget: str, seconds: float):
+        super().__init__(f"Dify did not respond within the {budget} budget ({seconds:g}s)")
+        self.budget = budget
+        self.seconds = seconds
+
+def httpx_timeout_error(error: httpx.TimeoutException, timeout: httpx.Timeout) -> DifyTimeoutError:
+    budget = HTTPX_TIMEOUT_BUDGETS.get(type(error), "idle")
+    metrics.inc(f"dify_{budget}_budget_exceeded_total")
+    return DifyTimeoutError(budget, getattr(timeout, "read" if budget == "idle" else budget) or 0)
+
+class StreamBudget:
+    """Deadlines for one Dify call, measured on the event loop clock from ``started``.
+
+    ``first_event`` bounds the wait for the first answer delta, ``total`` the
+    whole call and ``client_deadline`` (when given) whatever the caller asked for.
+    ``started`` defaults to now; calls made for the same request (e.g. a hedge)
+    pass the request's start so they share its deadlines.
+    """
+
+    def __init__(
+        self,
+        first_event: float,
+        total: float,
+        client_timeout: Optional[float] = None,
+        started: Optional[float] = None
+    ):
+        self._loop = asyncio.get_running_loop()
+        now = self._loop.time() if started is None else started
+        self._budgets: Dict[str, Tuple[float, float]] = {
+            "first_event": (now + first_event, first_event),
+            "total": (now + total, total),
+        }
+        if client_timeout is not None:
+            self._budgets["client_deadline"] = (now + client_timeout, client_timeout)
+        self.first_event_seen = False
+
+    def next(self) -> Tuple[str, float]:
+        """The budget that runs out first, and its deadline."""
+        deadline, name = min(
+            (deadline, name)
+            for name, (deadline, _) in self._budgets.items()
+            if not (name == "first_event" and self.first_event_seen)
+        )
+        return name, deadline
+
+    def remaining(self) -> float:
+        return self.next()[1] - self._loop.time()
+
+    def exceeded(self, name: str) -> DifyTimeoutError:
+        metrics.inc(f"dify_{name}_budget_exceeded_total")
+        return DifyTimeoutError(name, self._budgets[name][1])
+
+def create_http_timeout() -> httpx.Timeout:
+    # ``read`` applies to every socket read, so it bounds the idle gap between chunks
+    return httpx.Timeout(
+        connect=float(os.getenv("DIFY_CONNECT_TIMEOUT", "5")),
+        read=float(os.getenv("DIFY_IDLE_TIMEOUT", "30")),
+        write=float(os.getenv("DIFY_WRITE_TIMEOUT", "10")),
+        pool=float(os.getenv("DIFY_POOL_TIMEOUT", "10")),
+    )
@@ -0,0 +1,111 @@
+import json
+import os
+import random
+import re
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+from .circuit_breaker import CircuitBreakers
+from .metrics import metrics
+from .rate_limit import RateLimiter, create_rate_limiter
+
+DEFAULT_BASE_URL = "https://api.dify.ai/v1"
+
+class Upstream:
+    """One Dify app endpoint: a base URL and the API key of the app behind it."""
+
+    def __init__(self, name: str, base_url: str, api_key: str, weight: float = 1.0):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.weight = weight
+        self.outstanding = 0
+        # Each key has its own Dify quota
+        self.rate_limiter: RateLimiter = create_rate_limiter()
+
+    def acquire(self):
+        self.outstanding += 1
+        metrics.set(f"dify_upstream_{self.name}_outstanding", self.outstanding)
+
+    def release(self):
+        self.outstanding -= 1
+        metrics.set(f"dify_upstream_{self.name}_outstanding", self.outstanding)
+
+class UpstreamPool:
+    """Weighted least-outstanding-requests balancing over Dify upstreams.
+
+    New conversations go to the healthy upstream with the fewest in-flight
+    streams per unit of weight; an upstream is ejected from rotation while
+    its ``<name>_chat_messages`` circuit breaker is open. A conversation has
+    to stay on the upstream (app) that created it, so the pool remembers up
+    to ``max_affinity`` conversation ids. For an id it does not know (e.g.
+    after a restart) every upstream is a candidate, to be tried in turn.
+    """
+
+    def __init__(self, upstreams: List[Upstream], breakers: CircuitBreakers, max_affinity: int = 100000):
+        if not upstreams:
+            raise ValueError("At least one Dify upstream must be configured")
+        self.upstreams = upstreams
+        self.breakers = breakers
+        self.max_affinity = max_affinity
+        self._by_name = {upstream.name: upstream for upstream in upstreams}
+        self._affinity: "OrderedDict[str, str]" = OrderedDict()
+
+    def pick(self, exclude: Iterable[str] = ()) -> Upstream:
+        exclude = set(exclude)
+        allowed = [u for u in self.upstreams if u.name not in exclude] or self.upstreams
+        healthy = [u for u in allowed if self.breakers.get(f"{u.name}_chat_messages").available()]
+        if not healthy:
+            metrics.inc("dify_upstreams_all_ejected_total")
+            healthy = allowed
+        lowest = min((u.outstanding + 1) / u.weight for u in healthy)
+        return random.choice([u for u in healthy if (u.outstanding + 1) / u.weight == lowest])
+
+    def candidates(self, conversation_id: Optional[str]) -> List[Upstream]:
+        """Upstreams to try, in order, for a call in ``conversation_id``."""
+        if not conversation_id:
+            return [self.pick()]
+        name = self._affinity.get(conversation_id)
+        if name is not None:
+            self._affinity.move_to_end(conversation_id)
+            return [self._by_name[name]]
+        if len(self.upstreams) == 1:
+            return list(self.upstreams)
+        metrics.inc("dify_affinity_misses_total")
+        first = self.pick()
+        return [first] + [u for u in self.upstreams if u is not first]
+
+    def bind(self, conversation_id: str, upstream: Upstream):
+        if len(self.upstreams) == 1:
+            return
+        self._affinity[conversation_id] = upstream.name
+        self._affinity.move_to_end(conversation_id)
+        while len(self._affinity) > self.max_affinity:
+            self._affinity.popitem(last=False)
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9_]", "_", name.lower())
+
+def create_upstream_pool(breakers: CircuitBreakers) -> UpstreamPool:
+    """Build the pool from DIFY_UPSTREAMS (JSON), or from DIFY_API_URL/DIFY_API_KEY."""
+    raw = os.getenv("DIFY_UPSTREAMS")
+    if raw:
+        upstreams = [
+            Upstream(
+                name=_metric_name(item.get("name") or f"upstream{i}"),
+                base_url=item.get("base_url") or DEFAULT_BASE_URL,
+                api_key=item["api_key"],
+                weight=float(item.get("weight", 1)),
+            )
+            for i, item in enumerate(json.loads(raw))
+        ]
+    else:
+        api_key = os.getenv("DIFY_API_KEY")
+        if not api_key:
+            raise ValueError("DIFY_API_KEY must be set")
+        upstreams = [Upstream("default", os.getenv("DIFY_API_URL") or DEFAULT_BASE_URL, api_key)]
+    return UpstreamPool(
+        upstreams,
+        breakers,
+        max_affinity=int(os.getenv("DIFY_AFFINITY_MAX_CONVERSATIONS", "100000")),
+    )
@@ -0,0 +1,114 @@
+"""History query latency with and without the conversations indexes.
+
+Seeds a file-backed SQLite database with ``--rows`` conversations (1M by
+default) and times the queries behind ``/api/chat/history`` before and after
+creating the indexes declared on ``Conversation``.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_history_indexes [--rows 1000000] [--db /tmp/history.db]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import desc, select
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app.database import Conversation
+
+def seed(path: str, rows: int, conversations: int):
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    connection.execute(str(CreateTable(Conversation.__table__).compile(dialect=sqlite.dialect())))
+    start = datetime(2025, 1, 1)
+    conversation_ids = [str(uuid.uuid4()) for _ in range(conversations)]
+    batch = []
+    for i in range(rows):
+        # Raw rows use the SQLite storage format of Conversation's Uuid/UTCDateTime columns
+        batch.append((
+            uuid.uuid4().hex,
+            f"question {i}",
+            f"answer {i}",
+            # Second resolution, so neighbouring rows share timestamps as in production
+            (start + timedelta(seconds=i // 3)).isoformat(sep=" "),
+            uuid.UUID(random.choice(conversation_ids)).hex,
+        ))
+        if len(batch) == 50_000:
+            connection.executemany("INSERT INTO conversations VALUES (?, ?, ?, ?, ?)", batch)
+            batch.clear()
+    if batch:
+        connection.executemany("INSERT INTO conversations VALUES (?, ?, ?, ?, ?)", batch)
+    connection.commit()
+    connection.close()
+    return conversation_ids
+
+async def time_query(session_factory, stmt, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        async with session_factory() as session:
+            start = time.perf_counter()
+            (await session.execute(stmt)).scalars().all()
+            samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+async def measure(path: str, conversation_ids, repeat: int):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    before = datetime(2025, 1, 2)
+    queries = {
+        "latest 50": select(Conversation).order_by(desc(Conversation.timestamp)).limit(50),
+        "50 before ts": select(Conversation)
+            .where(Conversation.timestamp < before)
+            .order_by(desc(Conversation.timestamp)).limit(50),
+        "conversation 50": select(Conversation)
+            .where(Conversation.conversation_id == conversation_ids[0])
+            .order_by(desc(Conversation.timestamp)).limit(50),
+    }
+    results = {name: await time_query(session_factory, stmt, repeat) for name, stmt in queries.items()}
+    await engine.dispose()
+    return results
+
+def create_indexes(path: str):
+    connection = sqlite3.connect(path)
+    for index in Conversation.__table__.indexes:
+        connection.execute(str(CreateIndex(index).compile(dialect=sqlite.dialect())))
+    connection.execute("ANALYZE")
+    connection.commit()
+    connection.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--conversations", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--db", default="/tmp/bench_history.db")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    conversation_ids = seed(args.db, args.rows, args.conversations)
+    print(f"seeded {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+    without = asyncio.run(measure(args.db, conversation_ids, args.repeat))
+    start = time.perf_counter()
+    create_indexes(args.db)
+    print(f"created indexes in {time.perf_counter() - start:.1f}s")
+    with_indexes = asyncio.run(measure(args.db, conversation_ids, args.repeat))
+
+    print(f"{'query':<18}{'no index (ms)':>15}{'indexed (ms)':>15}")
+    for name in without:
+        print(f"{name:<18}{without[name]:>15.2f}{with_indexes[name]:>15.2f}")
+    os.remove(args.db)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Concurrent chat-transcript insert throughput for the SQLite modes.
+
+Each worker repeatedly inserts one Conversation row and commits, as the
+``/api/chat`` handler does, with ``--concurrency`` workers running at once.
+Compares the old in-memory default, a file database with SQLite's default
+rollback journal, and the file database with the WAL pragmas from
+``app.database``.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_sqlite_inserts [--rows 5000] [--concurrency 32]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base, Conversation, build_engine
+
+async def insert_rows(url: str, tune_sqlite: bool, rows: int, concurrency: int) -> float:
+    engine = build_engine(url, tune_sqlite=tune_sqlite)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    remaining = iter(range(rows))
+
+    async def worker():
+        for i in remaining:
+            async with session_factory() as session:
+                session.add(Conversation(
+                    id=str(uuid.uuid4()),
+                    user_message=f"question {i}",
+                    assistant_message="answer " * 50,
+                    conversation_id=str(uuid.uuid4()),
+                    timestamp=datetime.utcnow(),
+                ))
+                await session.commit()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    return rows / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        modes = [
+            ("memory (old default)", "sqlite+aiosqlite:///:memory:", False),
+            ("file, rollback journal", f"sqlite+aiosqlite:///{os.path.join(directory, 'plain.db')}", False),
+            ("file, WAL + pragmas", f"sqlite+aiosqlite:///{os.path.join(directory, 'wal.db')}", True),
+        ]
+        print(f"{args.rows} inserts, {args.concurrency} concurrent workers")
+        for name, url, tune in modes:
+            rate = asyncio.run(insert_rows(url, tune, args.rows, args.concurrency))
+            print(f"{name:<24}{rate:>10.0f} rows/s")
+
+if __name__ == "__main__":
+    main()
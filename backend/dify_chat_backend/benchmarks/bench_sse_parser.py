@@ -0,0 +1,132 @@
+"""Micro-benchmark for the Dify SSE parsing path.
+
+Compares the previous ``aiter_lines()`` loop (``full_response += answer``)
+with ``app.sse.aiter_events`` on a synthetic stream of 100k message events.
+Both read the same chunked body through a real ``httpx.Response``, so
+decoding and async-iteration overhead are included.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_sse_parser [--events 100000] [--chunk-size 512] [--node-every 10]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from app.sse import aiter_events
+
+NODE_OUTPUT = "x" * 2048
+
+def build_stream(events: int, node_every: int = 0) -> str:
+    parts = []
+    for i in range(events):
+        if node_every and i % node_every == 0:
+            # Chatflow apps interleave workflow/node events with the answer
+            node = {
+                "event": "node_finished",
+                "task_id": "task-1",
+                "workflow_run_id": "run-1",
+                "data": {"node_id": f"node-{i}", "outputs": {"text": NODE_OUTPUT}},
+            }
+            parts.append(f"data: {json.dumps(node)}\n\n")
+        chunk = {
+            "event": "message",
+            "task_id": "task-1",
+            "message_id": "message-1",
+            "conversation_id": "conversation-1",
+            "answer": f"token{i % 97} ",
+        }
+        parts.append(f"data: {json.dumps(chunk)}\n\n")
+        if i % 1000 == 0:
+            parts.append("event: ping\n\n")
+    parts.append('data: {"event": "message_end", "conversation_id": "conversation-1"}\n\n')
+    return "".join(parts)
+
+class ChunkedBody(httpx.AsyncByteStream):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+def split_chunks(stream: str, size: int):
+    data = stream.encode()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def make_response(chunks) -> httpx.Response:
+    return httpx.Response(200, stream=ChunkedBody(chunks), headers={"content-type": "text/event-stream"})
+
+async def legacy(chunks) -> str:
+    # The loop DifyClient.chat used before the incremental parser
+    full_response = ""
+    current_conversation_id = None
+    async for line in make_response(chunks).aiter_lines():
+        if not line.strip():
+            continue
+        if line.startswith("data: "):
+            data = line[6:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(chunk, dict):
+                message_data = chunk.get("answer", "")
+                if message_data:
+                    full_response += message_data
+                if not current_conversation_id:
+                    current_conversation_id = (
+                        chunk.get("conversation_id") or
+                        chunk.get("id") or
+                        (chunk.get("data", {}).get("conversation_id") if isinstance(chunk.get("data"), dict) else None)
+                    )
+    return full_response
+
+async def incremental(chunks) -> str:
+    # Same dispatch as DifyClient.chat_stream, minus the per-request bookkeeping
+    answer_parts = []
+    async for event in aiter_events(make_response(chunks).aiter_text()):
+        if event.event == "ping":
+            continue
+        chunk = json.loads(event.data.strip())
+        event_type = chunk.get("event")
+        if event_type == "message":
+            answer_parts.append(chunk["answer"])
+        elif event_type == "message_end":
+            break
+    return "".join(answer_parts)
+
+def run(name, fn, chunks, stream_bytes, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        answer = asyncio.run(fn(chunks))
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<12} {best * 1000:9.1f} ms  {stream_bytes / best / 1e6:7.1f} MB/s  answer={len(answer)} chars")
+    return answer
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--node-every", type=int, default=0,
+                        help="emit a 2 KB node_finished event every N answer chunks (chatflow apps)")
+    args = parser.parse_args()
+
+    stream = build_stream(args.events, args.node_every)
+    chunks = split_chunks(stream, args.chunk_size)
+    stream_bytes = sum(len(chunk) for chunk in chunks)
+    print(f"{args.events} events, {len(chunks)} chunks of {args.chunk_size} bytes, {stream_bytes / 1e6:.1f} MB")
+
+    expected = run("legacy", legacy, chunks, stream_bytes, args.repeat)
+    actual = run("incremental", incremental, chunks, stream_bytes, args.repeat)
+    assert expected == actual
+
+if __name__ == "__main__":
+    main()
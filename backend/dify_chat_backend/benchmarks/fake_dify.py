@@ -0,0 +1,193 @@
+"""Local stand-in for the Dify chat API, for benchmarks and offline testing.
+
+Serves ``POST /v1/chat-messages`` in streaming mode with the same SSE framing
+as Dify (``message`` deltas, ``ping`` keep-alives, a closing ``message_end``
+with usage) and ``POST /v1/chat-messages/{task_id}/stop``. Time to first
+byte, token rate and answer length are configurable, and a share of requests
+can be made to fail with a 500, get rate limited with a 429 and
+``Retry-After``, emit an in-stream ``error`` event, or stall mid-answer until
+the client gives up. Counters are served at ``GET /fake/stats``.
+
+Run from the backend directory:
+
+    python -m benchmarks.fake_dify [--port 8001] [--ttfb 0.3] [--tokens-per-second 50] [--answer-tokens 100]
+
+and point the backend at it with ``DIFY_API_URL=http://127.0.0.1:8001/v1``
+(any ``DIFY_API_KEY`` is accepted).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+from typing import List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "the a of to and in is it that for on with as this be are was by at from "
+    "Dify answer stream token model chat request latency backend server cache"
+).split()
+
+# Options shared with benchmarks.load_test, which starts this server in a subprocess
+OPTIONS = (
+    "ttfb", "tokens_per_second", "answer_tokens", "ping_interval", "error_rate",
+    "rate_limit_rate", "retry_after", "stream_error_rate", "stall_rate", "seed",
+)
+
+def add_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("fake Dify")
+    group.add_argument("--ttfb", type=float, default=0.3, help="seconds before the first answer delta")
+    group.add_argument("--tokens-per-second", type=float, default=50.0, help="answer deltas per second (0 = no delay)")
+    group.add_argument("--answer-tokens", type=int, default=100, help="answer deltas per response")
+    group.add_argument("--ping-interval", type=float, default=10.0, help="seconds between pings while waiting")
+    group.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    group.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    group.add_argument("--retry-after", type=int, default=1, help="Retry-After sent with injected 429s")
+    group.add_argument("--stream-error-rate", type=float, default=0.0, help="share of streams ending in an error event")
+    group.add_argument("--stall-rate", type=float, default=0.0, help="share of streams that stop sending mid-answer")
+    group.add_argument("--seed", type=int, default=None)
+
+def to_argv(args: argparse.Namespace) -> List[str]:
+    return [
+        f"--{name.replace('_', '-')}={getattr(args, name)}"
+        for name in OPTIONS
+        if getattr(args, name) is not None
+    ]
+
+def sse(event: dict) -> str:
+    # Dify's own serialisation: ``data: {"event": ...}`` with ", " / ": " separators
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    app = FastAPI(title="Fake Dify")
+    rng = random.Random(args.seed)
+    stats: Counter = Counter()
+    conversations = set()
+    active = set()
+    stopped = set()
+
+    async def wait(seconds: float):
+        # Dify keeps idle streams alive with ``event: ping`` while the model works
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, args.ping_interval))
+            if deadline - time.monotonic() > 0:
+                yield "event: ping\n\n"
+
+    async def answer_stream(conversation_id: str, task_id: str, query: str, stall: bool, fail: bool):
+        message_id = str(uuid.uuid4())
+        cut_at = rng.randint(1, max(args.answer_tokens - 1, 1)) if stall or fail else None
+        delay = 1 / args.tokens_per_second if args.tokens_per_second > 0 else 0
+        active.add(task_id)
+        stats["streams_active"] += 1
+        try:
+            async for ping in wait(args.ttfb):
+                yield ping
+            for i in range(args.answer_tokens):
+                if task_id in stopped:
+                    stats["streams_stopped"] += 1
+                    return
+                if i == cut_at:
+                    if stall:
+                        stats["streams_stalled"] += 1
+                        # Hold the connection open without sending anything
+                        await asyncio.Event().wait()
+                    stats["streams_errored"] += 1
+                    yield sse({
+                        "event": "error", "task_id": task_id, "message_id": message_id,
+                        "status": 500, "code": "internal_server_error", "message": "Injected stream error",
+                    })
+                    return
+                word = rng.choice(WORDS)
+                yield sse({
+                    "event": "message", "task_id": task_id, "message_id": message_id,
+                    "conversation_id": conversation_id, "answer": word if i == 0 else f" {word}",
+                    "created_at": int(time.time()),
+                })
+                if delay:
+                    await asyncio.sleep(delay)
+            prompt_tokens = max(len(query) // 4, 1)
+            yield sse({
+                "event": "message_end", "task_id": task_id, "message_id": message_id,
+                "conversation_id": conversation_id,
+                "metadata": {"usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": args.answer_tokens,
+                    "total_tokens": prompt_tokens + args.answer_tokens,
+                }},
+            })
+            stats["streams_completed"] += 1
+        finally:
+            stats["streams_active"] -= 1
+            active.discard(task_id)
+            stopped.discard(task_id)
+
+    @app.post("/v1/chat-messages")
+    async def chat_messages(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        roll = rng.random()
+        if roll < args.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse(
+                {"code": "too_many_requests", "message": "Injected rate limit", "status": 429},
+                status_code=429,
+                headers={"Retry-After": str(args.retry_after)},
+            )
+        if roll < args.rate_limit_rate + args.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(
+                {"code": "internal_server_error", "message": "Injected error", "status": 500},
+                status_code=500,
+            )
+
+        conversation_id = body.get("conversation_id") or ""
+        if conversation_id and conversation_id not in conversations:
+            stats["not_found"] += 1
+            return JSONResponse(
+                {"code": "not_found", "message": "Conversation Not Exists.", "status": 404},
+                status_code=404,
+            )
+        if not conversation_id:
+            conversation_id = str(uuid.uuid4())
+            conversations.add(conversation_id)
+
+        roll = rng.random()
+        stall = roll < args.stall_rate
+        fail = not stall and roll < args.stall_rate + args.stream_error_rate
+        return StreamingResponse(
+            answer_stream(conversation_id, str(uuid.uuid4()), body.get("query") or "", stall, fail),
+            media_type="text/event-stream",
+        )
+
+    @app.post("/v1/chat-messages/{task_id}/stop")
+    async def stop(task_id: str):
+        stats["stop_requests"] += 1
+        if task_id in active:
+            stopped.add(task_id)
+        return {"result": "success"}
+
+    @app.get("/fake/stats")
+    async def get_stats():
+        return dict(stats)
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
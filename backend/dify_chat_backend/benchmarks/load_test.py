@@ -0,0 +1,258 @@
+"""End-to-end load test of the chat API against a local fake Dify.
+
+Starts ``benchmarks.fake_dify`` and the backend (``uvicorn app.main:app`` on
+a throwaway SQLite database) as subprocesses, then runs ``--concurrency``
+workers for ``--duration`` seconds, each issuing a weighted mix of
+``POST /api/chat``, ``POST /api/chat/stream`` and ``GET /api/chat/history``
+requests. A share of chat requests continue an earlier conversation. Reports
+throughput, p50/p95/p99 latency per request type, time to first answer delta
+for streams, and the backend's resident memory (sampled from ``/proc``).
+
+Backend settings are taken from the environment, so features can be compared
+by toggling them, e.g. ``RESPONSE_CACHE_ENABLED=true``. Pass ``--target`` to
+load an already running backend instead, and ``--dify-url`` to have the
+started backend use another Dify (fake or real) than the spawned fake.
+
+Run from the backend directory:
+
+    python -m benchmarks.load_test [--concurrency 50] [--duration 30] [--mix chat=4,stream=4,history=2] [--ttfb 0.3] [--tokens-per-second 50]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+import httpx
+
+from benchmarks import fake_dify
+
+class Results:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.ttft: List[float] = []
+        self.errors: Dict[str, Counter] = defaultdict(Counter)
+        self.conversations: Deque[str] = deque(maxlen=1000)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(math.ceil(fraction * len(ordered)) - 1, len(ordered) - 1)]
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("chat", "stream", "history"):
+            raise argparse.ArgumentTypeError(f"Unknown request type: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+async def wait_until_ready(client: httpx.AsyncClient, url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with {process.returncode}")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+def chat_body(args: argparse.Namespace, results: Results, sequence: int) -> dict:
+    message = f"Load test question {random.randrange(args.distinct_messages) if args.distinct_messages else sequence}"
+    if results.conversations and random.random() < args.follow_up:
+        return {"message": message, "conversation_id": random.choice(results.conversations)}
+    return {"message": message}
+
+async def send_chat(client: httpx.AsyncClient, body: dict, headers: dict, results: Results):
+    response = await client.post("/api/chat", json=body, headers=headers)
+    if response.status_code != 200:
+        return str(response.status_code)
+    results.conversations.append(response.json()["conversation_id"])
+    return None
+
+async def send_stream(client: httpx.AsyncClient, body: dict, headers: dict, results: Results, started: float):
+    async with client.stream("POST", "/api/chat/stream", json=body, headers=headers) as response:
+        if response.status_code != 200:
+            return str(response.status_code)
+        first = True
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[6:])
+            if event["event"] == "message" and first:
+                first = False
+                results.ttft.append(time.perf_counter() - started)
+            elif event["event"] == "error":
+                return "error event" + (f" ({event['budget']})" if "budget" in event else "")
+            elif event["event"] == "message_end":
+                results.conversations.append(event["conversation_id"])
+                return None
+    return "truncated"
+
+async def send_history(client: httpx.AsyncClient):
+    response = await client.get("/api/chat/history", params={"limit": 20})
+    return None if response.status_code == 200 else str(response.status_code)
+
+async def worker(client: httpx.AsyncClient, args: argparse.Namespace, results: Results, deadline: float, counter):
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    # Without --cache every chat reaches Dify; identical messages would otherwise be served from cache
+    headers = {} if args.cache else {"Cache-Control": "no-cache"}
+    while time.perf_counter() < deadline:
+        kind = random.choices(kinds, weights)[0]
+        started = time.perf_counter()
+        try:
+            if kind == "history":
+                error = await send_history(client)
+            elif kind == "chat":
+                error = await send_chat(client, chat_body(args, results, next(counter)), headers, results)
+            else:
+                error = await send_stream(client, chat_body(args, results, next(counter)), headers, results, started)
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        if error:
+            results.errors[kind][error] += 1
+        else:
+            results.latencies[kind].append(time.perf_counter() - started)
+
+async def sample_memory(pid: int, samples: List[float], interval: float = 0.5):
+    while True:
+        value = rss_mb(pid)
+        if value is not None:
+            samples.append(value)
+        await asyncio.sleep(interval)
+
+def report(results: Results, elapsed: float, memory: List[float]):
+    print(f"{'type':<9}{'ok':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    total = 0
+    for kind in ("chat", "stream", "history"):
+        latencies = results.latencies.get(kind, [])
+        errors = sum(results.errors[kind].values())
+        if not latencies and not errors:
+            continue
+        total += len(latencies)
+        row = f"{kind:<9}{len(latencies):>8}{errors:>8}{len(latencies) / elapsed:>9.1f}"
+        if latencies:
+            row += "".join(f"{percentile(latencies, p) * 1000:>9.0f}" for p in (0.5, 0.95, 0.99))
+        print(row)
+    print(f"{'total':<9}{total:>8}{'':>8}{total / elapsed:>9.1f}")
+    if results.ttft:
+        print("stream TTFT ms: " + "  ".join(
+            f"p{int(p * 100)} {percentile(results.ttft, p) * 1000:.0f}" for p in (0.5, 0.95, 0.99)
+        ))
+    for kind, errors in results.errors.items():
+        if errors:
+            print(f"{kind} errors: " + ", ".join(f"{reason} x{count}" for reason, count in errors.most_common()))
+    if memory:
+        print(f"backend RSS MB: start {memory[0]:.0f}  peak {max(memory):.0f}  end {memory[-1]:.0f}")
+
+async def run(args: argparse.Namespace, target: str, backend_pid: Optional[int]) -> Results:
+    results = Results()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=target, timeout=args.timeout, limits=limits) as client:
+        memory: List[float] = []
+        sampler = asyncio.create_task(sample_memory(backend_pid, memory)) if backend_pid else None
+        counter = iter(range(sys.maxsize))
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(
+            worker(client, args, results, deadline, counter) for _ in range(args.concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+        if sampler:
+            sampler.cancel()
+
+        print(f"{args.concurrency} workers, {elapsed:.1f}s, mix {args.mix}")
+        report(results, elapsed, memory)
+        if args.dify_url is None and args.target is None:
+            print(f"fake Dify: {(await client.get(f'{args.fake_url}/fake/stats')).json()}")
+    return results
+
+async def start_and_run(args: argparse.Namespace, directory: str):
+    processes: List[subprocess.Popen] = []
+    try:
+        async with httpx.AsyncClient(timeout=5) as client:
+            target = args.target
+            backend_pid = None
+            if target is None:
+                dify_url = args.dify_url
+                if dify_url is None:
+                    port = free_port()
+                    fake = subprocess.Popen([
+                        sys.executable, "-m", "benchmarks.fake_dify", f"--port={port}", *fake_dify.to_argv(args)
+                    ])
+                    processes.append(fake)
+                    args.fake_url = f"http://127.0.0.1:{port}"
+                    await wait_until_ready(client, f"{args.fake_url}/fake/stats", fake)
+                    dify_url = f"{args.fake_url}/v1"
+
+                port = free_port()
+                env = dict(os.environ)
+                env.setdefault("DIFY_API_KEY", "fake")
+                env.setdefault("LOG_LEVEL", "WARNING")
+                env.update(
+                    DIFY_API_URL=dify_url,
+                    DATABASE_URL=f"sqlite+aiosqlite:///{os.path.join(directory, 'chat.db')}",
+                )
+                env.pop("DIFY_UPSTREAMS", None)
+                backend = subprocess.Popen([
+                    sys.executable, "-m", "uvicorn", "app.main:app",
+                    "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+                ], env=env)
+                processes.append(backend)
+                target = f"http://127.0.0.1:{port}"
+                await wait_until_ready(client, f"{target}/healthz", backend)
+                backend_pid = backend.pid
+        await run(args, target, backend_pid)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--mix", type=parse_mix, default="chat=4,stream=4,history=2")
+    parser.add_argument("--follow-up", type=float, default=0.2, help="share of chats continuing an earlier conversation")
+    parser.add_argument("--distinct-messages", type=int, default=0, help="draw messages from this many variants (0 = all unique)")
+    parser.add_argument("--cache", action="store_true", help="let chats use the response cache")
+    parser.add_argument("--timeout", type=float, default=120.0, help="client timeout per request")
+    parser.add_argument("--target", help="URL of an already running backend")
+    parser.add_argument("--dify-url", help="Dify API URL for the started backend instead of a spawned fake")
+    fake_dify.add_arguments(parser)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="load_test_") as directory:
+        asyncio.run(start_and_run(args, directory))
+
+if __name__ == "__main__":
+    main()
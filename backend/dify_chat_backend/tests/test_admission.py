@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from app.admission import AdmissionController, UpstreamSaturated
+
+pytestmark = pytest.mark.anyio
+
+async def test_released_slots_go_to_waiters_in_arrival_order():
+    controller = AdmissionController(max_concurrency=1)
+    await controller.acquire()
+    admitted = []
+
+    async def wait(name):
+        await controller.acquire()
+        admitted.append(name)
+
+    waiters = [asyncio.create_task(wait(name)) for name in "abc"]
+    await asyncio.sleep(0)
+    for _ in waiters:
+        controller.release()
+        await asyncio.sleep(0)
+        # A newcomer queues behind the waiters instead of taking the slot
+        assert controller.active == 1
+    await asyncio.gather(*waiters)
+
+    assert admitted == ["a", "b", "c"]
+    controller.release()
+    assert controller.active == 0
+
+async def test_full_queue_rejects_immediately():
+    controller = AdmissionController(max_concurrency=1, max_queue=1)
+    await controller.acquire()
+    waiter = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+
+    with pytest.raises(UpstreamSaturated) as error:
+        await controller.acquire()
+    assert error.value.reason == "queue_full"
+
+    controller.release()
+    await waiter
+
+async def test_waiter_gives_up_after_queue_timeout():
+    controller = AdmissionController(max_concurrency=1, queue_timeout=0.05)
+    await controller.acquire()
+
+    with pytest.raises(UpstreamSaturated) as error:
+        await controller.acquire()
+    assert error.value.reason == "queue_timeout"
+    assert not controller._waiters
+
+    controller.release()
+    assert controller.active == 0
+
+async def test_slot_handed_to_a_waiter_that_gives_up_is_passed_on():
+    controller = AdmissionController(max_concurrency=1)
+    await controller.acquire()
+    giving_up = asyncio.create_task(controller.acquire())
+    next_in_line = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+
+    # The slot is handed over, then the waiter is cancelled before it resumes
+    controller.release()
+    giving_up.cancel()
+    (outcome,) = await asyncio.gather(giving_up, return_exceptions=True)
+    if not isinstance(outcome, asyncio.CancelledError):
+        # Before Python 3.12, wait_for keeps a result that arrives with the cancellation
+        controller.release()
+
+    await asyncio.wait_for(next_in_line, 1)
+    assert controller.active == 1
+    controller.release()
+    assert controller.active == 0 and not controller._waiters
@@ -0,0 +1,154 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from app.dify_client import DifyClient
+from app.rate_limit import UpstreamRateLimited
+
+pytestmark = pytest.mark.anyio
+
+def open_breaker(**settings) -> CircuitBreaker:
+    """A breaker that has just been opened, with its open period already over."""
+    breaker = CircuitBreaker("test", open_duration=30, **settings)
+    breaker._transition(OPEN)
+    breaker._opened_at -= breaker.open_duration
+    return breaker
+
+def test_opens_on_failure_rate():
+    breaker = CircuitBreaker("test", window_size=4, minimum_calls=4, failure_rate_threshold=0.5)
+    for failed in (True, True, True):
+        breaker.record(breaker.allow(), failed, 0.1)
+    # Too few calls to judge yet
+    assert breaker.state == CLOSED
+
+    breaker.record(breaker.allow(), False, 0.1)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.allow()
+    assert error.value.retry_after == 30
+
+def test_failures_leave_the_window():
+    breaker = CircuitBreaker("test", window_size=4, minimum_calls=4, failure_rate_threshold=0.5)
+    # Two failures in six calls, but never two among the last four
+    for failed in (True, False, False, False, False, True):
+        breaker.record(breaker.allow(), failed, 0.1)
+    assert breaker.state == CLOSED
+
+def test_opens_on_slow_call_rate():
+    breaker = CircuitBreaker("test", minimum_calls=2, slow_call_duration=1, slow_call_rate_threshold=0.5)
+    breaker.record(breaker.allow(), False, 0.1)
+    assert breaker.state == CLOSED
+    breaker.record(breaker.allow(), False, 2.0)
+    assert breaker.state == OPEN
+
+def test_half_open_admits_a_limited_number_of_probes():
+    breaker = open_breaker(half_open_max_calls=2)
+    assert breaker.available()
+
+    assert breaker.allow() is True
+    assert breaker.allow() is True
+    assert breaker.state == HALF_OPEN
+    assert not breaker.available()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    breaker.record(True, False, 0.1)
+    # A successful probe still counts towards the limit
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record(True, False, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.allow() is False
+
+def test_failed_probe_reopens():
+    breaker = open_breaker()
+    probe = breaker.allow()
+    breaker.record(probe, True, 0.1)
+
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+def test_slow_probe_reopens():
+    breaker = open_breaker(slow_call_duration=1)
+    breaker.record(breaker.allow(), False, 2.0)
+    assert breaker.state == OPEN
+
+def test_released_probe_frees_its_place():
+    breaker = open_breaker(half_open_max_calls=1)
+    breaker.release(breaker.allow())
+
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() is True
+
+@pytest.fixture
+async def rate_limited_client(monkeypatch, mock_dify):
+    """A DifyClient allowed one call every two seconds."""
+    monkeypatch.setenv("DIFY_RATE_LIMIT_RPS", "0.5")
+    monkeypatch.setenv("CIRCUIT_OPEN_SECONDS", "30")
+    client = DifyClient()
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(mock_dify.handler))
+    yield client
+    await client.close()
+
+async def test_open_circuit_fails_fast_without_spending_rate_limit_tokens(rate_limited_client, mock_dify):
+    breaker = rate_limited_client.breakers.get("default_chat_messages")
+    breaker._transition(OPEN)
+    limiter = rate_limited_client.pool.upstreams[0].rate_limiter
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    for _ in range(3):
+        with pytest.raises(CircuitOpenError):
+            await rate_limited_client.chat("hello")
+
+    assert loop.time() - started < 0.5
+    assert limiter.requests.tokens == pytest.approx(1, abs=0.01)
+    assert mock_dify.payloads == []
+
+async def test_probe_is_released_when_the_rate_limiter_rejects(rate_limited_client):
+    breaker = rate_limited_client.breakers.get("default_chat_messages")
+    breaker._transition(OPEN)
+    breaker._opened_at -= breaker.open_duration
+    rate_limited_client.pool.upstreams[0].rate_limiter.observe(429, {"retry-after": "60"})
+
+    with pytest.raises(UpstreamRateLimited):
+        await rate_limited_client.chat("hello")
+
+    assert breaker.state == HALF_OPEN
+    assert breaker._probes_in_flight == 0
+
+@pytest.fixture
+def strict_breaker(monkeypatch):
+    """Any counted failure opens the circuit; no retries."""
+    monkeypatch.setenv("CIRCUIT_MINIMUM_CALLS", "1")
+    monkeypatch.setenv("DIFY_RETRY_MAX_ATTEMPTS", "1")
+
+async def test_429_does_not_count_as_a_failure(strict_breaker, dify_client):
+    dify_client._client = httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(429, headers={"retry-after": "1"})
+    ))
+    with pytest.raises(UpstreamRateLimited):
+        await dify_client.chat("hello")
+
+    breaker = dify_client.breakers.get("default_chat_messages")
+    assert breaker.state == CLOSED and not breaker._window
+
+async def test_cancelled_call_does_not_count(strict_breaker, dify_client):
+    call = asyncio.create_task(dify_client.chat("hello"))
+    await asyncio.sleep(0.05)
+    call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await call
+
+    breaker = dify_client.breakers.get("default_chat_messages")
+    assert breaker.state == CLOSED and not breaker._window
+
+async def test_5xx_counts_as_a_failure(strict_breaker, dify_client):
+    dify_client._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(503)))
+    with pytest.raises(httpx.HTTPStatusError):
+        await dify_client.chat("hello")
+
+    assert dify_client.breakers.get("default_chat_messages").state == OPEN
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.timeouts import DifyTimeoutError
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def hedging(monkeypatch):
+    monkeypatch.setenv("DIFY_HEDGING", "true")
+    monkeypatch.setenv("DIFY_HEDGE_DEFAULT_DELAY", "0.1")
+
+def sse(**chunk) -> bytes:
+    return f"data: {json.dumps(chunk)}\n\n".encode()
+
+class SlowFirstDify:
+    """The first request reports its task id after ``task_id_delay`` and then stalls;
+    later ones answer after ``delay``. Stop calls are kept in ``stopped``."""
+
+    def __init__(self, task_id_delay: float = 0.0, delay: float = 0.0):
+        self.task_id_delay = task_id_delay
+        self.delay = delay
+        self.requests = 0
+        self.stopped = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/stop"):
+            self.stopped.append(request.url.path.split("/")[-2])
+            return httpx.Response(200, json={"result": "success"})
+        self.requests += 1
+        task_id = f"t{self.requests}"
+        if self.requests == 1:
+            body = self.stalled(task_id)
+        else:
+            await asyncio.sleep(self.delay)
+            body = (
+                sse(event="message", task_id=task_id, conversation_id="dify-2", answer="hi")
+                + sse(event="message_end", task_id=task_id, conversation_id="dify-2")
+            )
+        return httpx.Response(200, content=body, headers={"content-type": "text/event-stream"})
+
+    async def stalled(self, task_id: str):
+        await asyncio.sleep(self.task_id_delay)
+        yield sse(event="workflow_started", task_id=task_id, conversation_id="dify-1")
+        await asyncio.sleep(10)
+
+def use(dify_client, upstream: SlowFirstDify):
+    dify_client._client = httpx.AsyncClient(transport=httpx.MockTransport(upstream.handler))
+
+async def test_backup_shares_the_request_deadline(dify_client):
+    use(dify_client, SlowFirstDify(task_id_delay=10, delay=0.25))
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    with pytest.raises(DifyTimeoutError) as error:
+        await dify_client.chat("hello", timeout=0.3)
+
+    # The backup started 0.1s in and would answer at 0.35s, past the caller's deadline
+    assert error.value.budget == "client_deadline"
+    assert loop.time() - started < 0.34
+
+async def test_loser_is_stopped_once_its_task_id_arrives(dify_client):
+    upstream = SlowFirstDify(task_id_delay=0.3)
+    use(dify_client, upstream)
+    result = await dify_client.chat("hello")
+
+    # The backup won before the primary reported a task id
+    assert result["answer"] == "hi"
+    assert upstream.stopped == []
+    await dify_client.close()
+    assert upstream.stopped == ["t1"]
+
+async def test_cancelled_request_closes_every_call_at_once(dify_client):
+    use(dify_client, SlowFirstDify(task_id_delay=10, delay=10))
+    call = asyncio.create_task(dify_client.chat("hello"))
+    await asyncio.sleep(0.2)
+    assert dify_client.in_flight == 2
+
+    call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await call
+
+    # The client went away: nothing is left holding a connection or a slot
+    assert dify_client.in_flight == 0
+    assert dify_client.admission.active == 0
+    assert not dify_client._background_tasks
@@ -0,0 +1,96 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.database import Conversation
+from app.persistence import insert_conversations
+
+pytestmark = pytest.mark.anyio
+
+def make_row(conversation_id: str, timestamp: datetime, text: str = "hello") -> Conversation:
+    return Conversation(
+        id=str(uuid.uuid4()),
+        user_message=text,
+        assistant_message=f"echo: {text}",
+        conversation_id=conversation_id,
+        timestamp=timestamp,
+    )
+
+async def test_chat_round_trip(client):
+    response = await client.post("/api/chat", json={"message": "hello"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["message"] == "echo: hello"
+
+    follow_up = await client.post(
+        "/api/chat", json={"message": "again", "conversation_id": body["conversation_id"]}
+    )
+    assert follow_up.status_code == 200
+    assert follow_up.json()["conversation_id"] == body["conversation_id"]
+
+    history = await client.get("/api/chat/history", params={"conversation_id": body["conversation_id"]})
+    assert history.status_code == 200
+    rows = history.json()
+    assert [row["user_message"] for row in rows] == ["again", "hello"]
+    assert [row["assistant_message"] for row in rows] == ["echo: again", "echo: hello"]
+    assert {row["conversation_id"] for row in rows} == {body["conversation_id"]}
+    assert rows[1]["timestamp"] == body["timestamp"]
+
+async def test_cursor_paging_with_equal_timestamps(client):
+    timestamp = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+    rows = [make_row(str(uuid.uuid4()), timestamp, f"message {i}") for i in range(5)]
+    await insert_conversations(rows)
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = await client.get("/api/chat/history", params=params)
+        assert response.status_code == 200
+        seen.extend(row["id"] for row in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    # Ties on timestamp are broken by id, so no row is skipped or repeated
+    assert seen == sorted((row.id for row in rows), reverse=True)
+
+    # And back again from the last page
+    previous = await client.get("/api/chat/history", params={"limit": 2, "cursor": response.headers["X-Prev-Cursor"]})
+    assert [row["id"] for row in previous.json()] == seen[2:4]
+
+async def test_conversation_id_filter(client):
+    now = datetime.now(timezone.utc)
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+    await insert_conversations([
+        make_row(first, now - timedelta(seconds=3)),
+        make_row(second, now - timedelta(seconds=2)),
+        make_row(first, now - timedelta(seconds=1)),
+    ])
+
+    response = await client.get("/api/chat/history", params={"conversation_id": first})
+    assert response.status_code == 200
+    assert [row["conversation_id"] for row in response.json()] == [first, first]
+
+    response = await client.get("/api/chat/history", params={"conversation_id": str(uuid.uuid4())})
+    assert response.json() == []
+
+async def test_timestamps_are_utc_with_z_suffix(client):
+    # Rows written with naive and non-UTC aware datetimes all read back as UTC
+    base = datetime(2025, 6, 1, 9, 30)
+    offset = timezone(timedelta(hours=9))
+    await insert_conversations([
+        make_row(str(uuid.uuid4()), base, "naive"),
+        make_row(str(uuid.uuid4()), (base + timedelta(hours=1)).replace(tzinfo=timezone.utc).astimezone(offset), "tokyo"),
+    ])
+
+    response = await client.get("/api/chat/history")
+    rows = response.json()
+    assert [row["user_message"] for row in rows] == ["tokyo", "naive"]
+    assert [row["timestamp"] for row in rows] == ["2025-06-01T10:30:00Z", "2025-06-01T09:30:00Z"]
+
+    response = await client.get("/api/chat/history", params={"before": "2025-06-01T10:00:00Z"})
+    assert [row["user_message"] for row in response.json()] == ["naive"]
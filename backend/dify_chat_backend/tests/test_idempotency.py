@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from app import main
+from app.idempotency import IdempotencyStore
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    store = IdempotencyStore()
+    monkeypatch.setattr(main, "idempotency_store", store)
+    return store
+
+@pytest.fixture
+def gated(dify, monkeypatch):
+    """Holds every chat turn until ``release`` is set; the first one fails if ``fail_first`` is."""
+    release = asyncio.Event()
+    state = {"fail_first": False}
+    chat = dify.chat
+
+    async def gated_chat(*args, **kwargs):
+        first = not dify.calls
+        await release.wait()
+        result = await chat(*args, **kwargs)
+        if first and state["fail_first"]:
+            raise RuntimeError("Dify is down")
+        return result
+
+    monkeypatch.setattr(dify, "chat", gated_chat)
+    return release, state
+
+def post(client, key: str, message: str = "hello"):
+    return client.post("/api/chat", json={"message": message}, headers={"Idempotency-Key": key})
+
+async def test_concurrent_duplicates_share_one_call(client, dify, gated):
+    release, _ = gated
+    requests = [asyncio.ensure_future(post(client, "k1")) for _ in range(3)]
+    await asyncio.sleep(0.05)
+    release.set()
+    responses = await asyncio.gather(*requests)
+
+    assert len(dify.calls) == 1
+    assert {r.status_code for r in responses} == {200}
+    assert len({r.json()["conversation_id"] for r in responses}) == 1
+    assert [r.headers.get("Idempotent-Replayed") for r in responses].count("true") == 2
+
+async def test_later_duplicate_is_replayed(client, dify):
+    first = await post(client, "k1")
+    again = await post(client, "k1")
+
+    assert len(dify.calls) == 1
+    assert "Idempotent-Replayed" not in first.headers
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.json() == first.json()
+
+async def test_different_body_is_rejected(client, dify):
+    await post(client, "k1", "hello")
+    response = await post(client, "k1", "goodbye")
+
+    assert response.status_code == 422
+    assert len(dify.calls) == 1
+
+async def test_duplicate_takes_over_when_the_first_request_fails(client, dify, gated):
+    release, state = gated
+    state["fail_first"] = True
+    leader = asyncio.ensure_future(post(client, "k1"))
+    await asyncio.sleep(0.05)
+    follower = asyncio.ensure_future(post(client, "k1"))
+    await asyncio.sleep(0.05)
+    release.set()
+
+    assert (await leader).status_code == 500
+    response = await follower
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    assert len(dify.calls) == 2
+
+async def test_duplicate_takes_over_when_the_first_caller_goes_away(store):
+    started = asyncio.Event()
+
+    async def hang():
+        started.set()
+        await asyncio.sleep(10)
+
+    leader = asyncio.ensure_future(store.run("k1", "f", hang))
+    await started.wait()
+    follower = asyncio.ensure_future(store.run("k1", "f", lambda: asyncio.sleep(0, "done")))
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    assert await follower == ("done", False)
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+async def test_results_expire_after_ttl():
+    store = IdempotencyStore(ttl=0)
+    calls = []
+
+    async def work():
+        calls.append(1)
+        return len(calls)
+
+    assert await store.run("k1", "f", work) == (1, False)
+    assert await store.run("k1", "f", work) == (2, False)
+
+async def test_oldest_keys_are_evicted_beyond_max_keys():
+    store = IdempotencyStore(max_keys=2)
+    for key in ("k1", "k2", "k3"):
+        await store.run(key, "f", lambda: asyncio.sleep(0, key))
+
+    assert await store.run("k3", "f", lambda: asyncio.sleep(0, "again")) == ("k3", True)
+    assert await store.run("k1", "f", lambda: asyncio.sleep(0, "again")) == ("again", False)
@@ -0,0 +1,68 @@
+import uuid
+
+import pytest
+from sqlalchemy import event, func, select
+
+from app import main, persistence
+from app.database import Conversation, utcnow
+from app.metrics import metrics
+from app.persistence import WriteBehindQueue
+
+pytestmark = pytest.mark.anyio
+
+def make_row(text: str = "hello") -> Conversation:
+    return Conversation(
+        id=str(uuid.uuid4()),
+        user_message=text,
+        assistant_message=f"echo: {text}",
+        conversation_id=str(uuid.uuid4()),
+        timestamp=utcnow(),
+    )
+
+async def count_rows(engine) -> int:
+    async with engine.connect() as conn:
+        return (await conn.execute(select(func.count()).select_from(Conversation))).scalar_one()
+
+async def test_failed_batch_is_retried(engine, monkeypatch):
+    insert = persistence.insert_conversations
+    calls = []
+
+    async def flaky_insert(conversations):
+        calls.append(len(conversations))
+        if len(calls) <= 2:
+            raise RuntimeError("database is locked")
+        await insert(conversations)
+
+    monkeypatch.setattr(persistence, "insert_conversations", flaky_insert)
+    writer = WriteBehindQueue(max_retries=3, retry_delay=0)
+    await writer._flush([make_row(), make_row()])
+
+    assert calls == [2, 2, 2]
+    assert await count_rows(engine) == 2
+
+async def test_bad_row_does_not_discard_the_batch(engine):
+    bad = make_row()
+    bad.user_message = None  # violates NOT NULL
+    writer = WriteBehindQueue(max_retries=1, retry_delay=0)
+    await writer._flush([make_row(), bad, make_row()])
+
+    assert await count_rows(engine) == 2
+
+async def test_chat_request_runs_one_insert_and_no_select(engine, client):
+    # conftest sets PERSISTENCE_WRITE_BEHIND=false, so the row is written inline
+    assert not main.WRITE_BEHIND_ENABLED and not main.conversation_writer.running
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.lstrip().split(None, 1)[0].upper())
+
+    before = metrics.snapshot()["counters"].get("db_statements_total", 0)
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = await client.post("/api/chat", json={"message": "hello"})
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+    assert response.status_code == 200
+    assert statements == ["INSERT"]
+    assert metrics.snapshot()["counters"]["db_statements_total"] - before == 1
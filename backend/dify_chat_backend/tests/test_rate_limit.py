@@ -0,0 +1,83 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+from app.rate_limit import RateLimiter, TokenBucket, UpstreamRateLimited, parse_retry_after
+
+pytestmark = pytest.mark.anyio
+
+def test_reservations_beyond_capacity_become_debt():
+    bucket = TokenBucket(rate=10, capacity=2)
+
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == 0
+    # Each later caller waits off the debt of those ahead of it
+    assert bucket.reserve(1) == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve(1) == pytest.approx(0.2, abs=0.01)
+
+    bucket.refund(1)
+    assert bucket.reserve(1) == pytest.approx(0.2, abs=0.01)
+
+def test_reported_usage_corrects_the_estimate():
+    limiter = RateLimiter(tokens_per_minute=600)
+    limiter.tokens.reserve(600)
+
+    limiter.record_usage(estimated_tokens=100, actual_tokens=700)
+    # 600 tokens of debt at 10 tokens/s
+    assert limiter.tokens.reserve(0) == pytest.approx(60, abs=0.1)
+
+    limiter.record_usage(estimated_tokens=700, actual_tokens=100)
+    assert limiter.tokens.reserve(0) == 0
+
+async def test_wait_beyond_max_wait_is_rejected_and_refunded():
+    limiter = RateLimiter(requests_per_second=1, burst=1, max_wait=0.5)
+    await limiter.acquire()
+
+    with pytest.raises(UpstreamRateLimited) as error:
+        await limiter.acquire()
+    assert error.value.retry_after == 1
+    # The rejected call's reservation was returned
+    assert limiter.requests.tokens == pytest.approx(0, abs=0.05)
+
+async def test_429_pauses_every_caller_and_halves_the_rate():
+    limiter = RateLimiter(requests_per_second=10, max_wait=0.1)
+
+    assert limiter.observe(429, {"retry-after": "5"}) == 5
+    assert limiter.rate_factor == 0.5
+    assert limiter.requests.rate == 5
+    with pytest.raises(UpstreamRateLimited) as error:
+        await limiter.acquire()
+    assert error.value.retry_after == 5
+
+def test_successful_calls_win_the_rate_back_gradually():
+    limiter = RateLimiter(requests_per_second=10)
+    limiter.observe(429, {})
+    limiter.observe(429, {})
+    assert limiter.rate_factor == 0.25
+
+    for _ in range(5):
+        limiter.observe(200, {})
+    assert limiter.rate_factor == pytest.approx(0.5)
+    for _ in range(20):
+        limiter.observe(200, {})
+    assert limiter.rate_factor == 1.0
+    assert limiter.requests.rate == 10
+
+def test_exhausted_rate_limit_header_pauses_without_halving():
+    limiter = RateLimiter(requests_per_second=10)
+
+    assert limiter.observe(200, {"x-ratelimit-remaining": "0", "x-ratelimit-reset": "3"}) == 3
+    assert limiter.rate_factor == 1.0
+    # Without a reset time there is nothing to wait for
+    assert limiter.observe(200, {"x-ratelimit-remaining": "0"}) is None
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after": "7"}) == 7
+    assert parse_retry_after({"retry-after": formatdate(time.time() + 30, usegmt=True)}) == pytest.approx(30, abs=1.5)
+    assert parse_retry_after({"retry-after": formatdate(time.time() - 30, usegmt=True)}) == 0
+    assert parse_retry_after({"ratelimit-reset": "2.5"}) == 2.5
+    # An epoch timestamp rather than a delay
+    assert parse_retry_after({"x-ratelimit-reset": str(int(time.time()) + 20)}) == pytest.approx(20, abs=1.5)
+    assert parse_retry_after({"retry-after": "soon"}) is None
+    assert parse_retry_after({}) is None
@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+from app.conversation_aliases import ConversationAliases
+from app.metrics import metrics
+from app.response_cache import SQLiteCacheStore
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def response_cache(monkeypatch):
+    monkeypatch.setenv("RESPONSE_CACHE_ENABLED", "true")
+
+async def test_hit_does_not_share_the_source_conversation(engine, dify_client, mock_dify):
+    miss = await dify_client.chat("What are your opening hours?")
+    hit = await dify_client.chat("What are your opening hours?")
+
+    assert not miss["cached"] and hit["cached"]
+    assert hit["answer"] == miss["answer"]
+    assert miss["conversation_id"] == "dify-1"
+    assert ConversationAliases.is_alias(hit["conversation_id"])
+    assert len(mock_dify.payloads) == 1
+
+    # The next turn opens a new Dify conversation instead of continuing dify-1
+    follow_up = await dify_client.chat("And on Sundays?", conversation_id=hit["conversation_id"])
+    assert follow_up["conversation_id"] == hit["conversation_id"]
+    assert mock_dify.payloads[-1]["conversation_id"] is None
+
+    # Each hit gets its own conversation
+    again = await dify_client.chat("What are your opening hours?")
+    assert again["cached"] and again["conversation_id"] != hit["conversation_id"]
+
+async def test_sqlite_store_counts_expiry_and_eviction_on_the_event_loop(tmp_path):
+    store = SQLiteCacheStore(str(tmp_path / "cache.db"), max_entries=1, prune_every=3)
+    try:
+        before = metrics.snapshot()["counters"]
+        await store.set("old", {"answer": "a"}, time.time() - 1)
+        assert await store.get("old") is None
+        await store.set("k1", {"answer": "b"}, time.time() + 60)
+        await store.set("k2", {"answer": "c"}, time.time() + 60)
+        assert await store.get("k1") is None
+        assert (await store.get("k2"))[0] == {"answer": "c"}
+        after = metrics.snapshot()["counters"]
+    finally:
+        await store.close()
+
+    assert after["response_cache_expired_total"] - before.get("response_cache_expired_total", 0) == 1
+    assert after["response_cache_evictions_total"] - before.get("response_cache_evictions_total", 0) == 1
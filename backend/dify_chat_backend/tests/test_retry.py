@@ -0,0 +1,42 @@
+import httpx
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setenv("DIFY_RETRY_BASE_DELAY", "0")
+
+def failing_once(mock_dify, error: Exception):
+    """A transport whose first request fails with ``error`` before reaching ``mock_dify``."""
+    attempts = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        attempts.append(request)
+        if len(attempts) == 1:
+            raise error
+        return await mock_dify.handler(request)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), attempts
+
+async def test_connect_error_is_retried(dify_client, mock_dify):
+    dify_client._client, attempts = failing_once(mock_dify, httpx.ConnectError("refused"))
+    result = await dify_client.chat("hello", conversation_id="dify-1")
+
+    assert result["answer"] == "hi"
+    assert len(attempts) == 2
+
+async def test_read_error_in_a_conversation_is_not_retried(dify_client, mock_dify):
+    dify_client._client, attempts = failing_once(mock_dify, httpx.ReadError("connection reset"))
+    with pytest.raises(httpx.ReadError):
+        await dify_client.chat("hello", conversation_id="dify-1")
+
+    # Dify may already have added the turn; sending it again would duplicate it
+    assert len(attempts) == 1
+
+async def test_read_error_on_a_new_conversation_is_retried(dify_client, mock_dify):
+    dify_client._client, attempts = failing_once(mock_dify, httpx.ReadError("connection reset"))
+    result = await dify_client.chat("hello")
+
+    assert result["answer"] == "hi"
+    assert len(attempts) == 2
@@ -0,0 +1,40 @@
+import time
+
+from app.semantic_cache import SemanticCache, create_semantic_cache
+
+class KeywordEmbedder:
+    """A stand-in semantic model: which of a few topics a message is about."""
+
+    dim = 3
+    topics = (("password", "passwords"), ("refund", "money back"), ("hours", "open"))
+
+    def embed(self, text: str):
+        text = text.lower()
+        return [float(any(word in text for word in words)) for words in self.topics]
+
+def test_default_threshold_keeps_negations_apart():
+    cache = SemanticCache()
+    question = "Can I cancel my subscription at any time before the end of the current billing period?"
+    cache.set(question, {"answer": "Yes"})
+
+    assert cache.get(question.replace("Can I", "Can I not")) is None
+    assert cache.get(question.lower().replace("?", " ?")) == {"answer": "Yes"}
+
+def test_embedder_is_configurable(monkeypatch):
+    monkeypatch.setenv("SEMANTIC_CACHE_ENABLED", "true")
+    monkeypatch.setenv("SEMANTIC_CACHE_EMBEDDER", "tests.test_semantic_cache:KeywordEmbedder")
+    monkeypatch.setenv("SEMANTIC_CACHE_THRESHOLD", "0.9")
+    cache = create_semantic_cache()
+    cache.set("How do I reset my password?", {"answer": "Use the link"})
+
+    assert isinstance(cache.embedder, KeywordEmbedder)
+    assert cache.get("How can I reset my passwords?") == {"answer": "Use the link"}
+    assert cache.get("When are you open?") is None
+
+def test_expired_best_match_does_not_hide_a_valid_one():
+    cache = SemanticCache(embedder=KeywordEmbedder(), threshold=0.7)
+    cache.set("password and refund", {"answer": "valid"})
+    cache.set("password", {"answer": "expired"}, expires_at=time.time() - 1)
+
+    assert cache.get("my password") == {"answer": "valid"}
+    assert "password" not in cache._entries
@@ -0,0 +1,64 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.dify_client import DifyClient
+from app.single_flight import SingleFlight
+from app.timeouts import DifyTimeoutError
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def single_flight(monkeypatch):
+    monkeypatch.setenv("DIFY_SINGLE_FLIGHT", "true")
+
+async def test_followers_get_their_own_conversation(engine, dify_client, mock_dify):
+    results = await asyncio.gather(*(dify_client.chat("same question") for _ in range(3)))
+
+    assert len(mock_dify.payloads) == 1
+    assert [r["answer"] for r in results] == ["hi"] * 3
+    ids = [r["conversation_id"] for r in results]
+    assert len(set(ids)) == 3
+    assert ids.count("dify-1") == 1
+
+    # A follower's next turn opens a new Dify conversation, and the one after
+    # continues it, even on another instance of the app
+    alias = next(i for i in ids if i != "dify-1")
+    first = await dify_client.chat("follow up", conversation_id=alias)
+    other = DifyClient()
+    other._client = httpx.AsyncClient(transport=httpx.MockTransport(mock_dify.handler))
+    try:
+        second = await other.chat("and again", conversation_id=alias)
+    finally:
+        await other.close()
+    assert first["conversation_id"] == second["conversation_id"] == alias
+    assert [p["conversation_id"] for p in mock_dify.payloads[1:]] == [None, "dify-2"]
+
+async def test_each_caller_keeps_its_own_deadline(dify_client):
+    patient = asyncio.create_task(dify_client.chat("same question"))
+    with pytest.raises(DifyTimeoutError) as error:
+        await dify_client.chat("same question", timeout=0.05)
+    assert error.value.budget == "client_deadline"
+
+    # The shared call carries on for the caller that is still waiting
+    assert (await patient)["answer"] == "hi"
+
+async def test_joining_during_teardown_starts_a_new_flight():
+    flights = SingleFlight()
+    started = []
+
+    async def upstream(name):
+        started.append(name)
+        yield name
+        await asyncio.sleep(10)
+
+    first = flights.stream("key", lambda: upstream("first"))
+    assert await anext(first) == "first"
+    await first.aclose()
+
+    # The abandoned flight is being cancelled; a new caller must not inherit that
+    second = flights.stream("key", lambda: upstream("second"))
+    assert await anext(second) == "second"
+    await second.aclose()
+    assert started == ["first", "second"]
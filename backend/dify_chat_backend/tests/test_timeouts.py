@@ -0,0 +1,47 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.rate_limit import UpstreamRateLimited
+from app.timeouts import DifyTimeoutError
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture(autouse=True)
+def rate_limit(monkeypatch):
+    monkeypatch.setenv("DIFY_RATE_LIMIT_RPS", "10")
+
+async def test_rate_limiter_wait_counts_against_the_deadline(dify_client, mock_dify):
+    limiter = dify_client.pool.upstreams[0].rate_limiter
+    limiter.observe(429, {"retry-after": "3"})
+    tokens = limiter.requests.tokens
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    with pytest.raises(DifyTimeoutError) as error:
+        await dify_client.chat("hello", timeout=0.3)
+
+    assert error.value.budget == "client_deadline"
+    assert loop.time() - started < 0.5
+    assert mock_dify.payloads == []
+    # The abandoned wait gave its reservation back
+    assert limiter.requests.tokens == pytest.approx(tokens, abs=0.1)
+
+async def test_429_is_not_retried_past_the_deadline(dify_client):
+    attempts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        attempts.append(request)
+        return httpx.Response(429, headers={"retry-after": "8"})
+
+    dify_client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    with pytest.raises(UpstreamRateLimited) as error:
+        await dify_client.chat("hello", timeout=1.0)
+
+    assert error.value.retry_after == 8
+    assert loop.time() - started < 0.5
+    assert len(attempts) == 1
@@ -0,0 +1,97 @@
+import json
+
+import httpx
+import pytest
+
+from app.circuit_breaker import OPEN, CircuitBreakers
+from app.dify_client import DifyClient
+from app.upstreams import Upstream, UpstreamPool
+
+from .conftest import MockDify
+
+pytestmark = pytest.mark.anyio
+
+class AppDify(MockDify):
+    """One Dify app: answers 404 for conversations created by another app."""
+
+    def __init__(self, name: str):
+        super().__init__(delay=0, prefix=name)
+        self.not_found = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        conversation_id = json.loads(request.content)["conversation_id"]
+        if conversation_id and not conversation_id.startswith(f"{self.prefix}-"):
+            self.not_found.append(conversation_id)
+            return httpx.Response(404, json={"code": "not_found", "message": "Conversation Not Exists."})
+        return await super().handler(request)
+
+@pytest.fixture
+def apps():
+    return {"a": AppDify("a"), "b": AppDify("b")}
+
+@pytest.fixture
+async def pooled_client(monkeypatch, apps):
+    """A DifyClient balancing over two Dify apps on separate hosts."""
+    monkeypatch.setenv("DIFY_UPSTREAMS", json.dumps([
+        {"name": name, "base_url": f"https://{name}.test/v1", "api_key": f"app-{name}"} for name in apps
+    ]))
+    client = DifyClient()
+    client._client = httpx.AsyncClient(mounts={
+        f"https://{name}.test": httpx.MockTransport(app.handler) for name, app in apps.items()
+    })
+    yield client
+    await client.close()
+
+def upstream(client: DifyClient, name: str) -> Upstream:
+    return next(u for u in client.pool.upstreams if u.name == name)
+
+def test_pick_prefers_the_fewest_outstanding_per_unit_of_weight():
+    pool = UpstreamPool(
+        [Upstream("a", "https://a.test/v1", "app-a", weight=2), Upstream("b", "https://b.test/v1", "app-b")],
+        CircuitBreakers(),
+    )
+    a, b = pool.upstreams
+
+    a.outstanding = 2  # (2 + 1) / 2 against (0 + 1) / 1
+    assert pool.pick() is b
+    a.outstanding, b.outstanding = 1, 1  # (1 + 1) / 2 against (1 + 1) / 1
+    assert pool.pick() is a
+    assert pool.pick(exclude=["a"]) is b
+
+def test_open_breaker_ejects_an_upstream():
+    breakers = CircuitBreakers()
+    pool = UpstreamPool([Upstream("a", "https://a.test/v1", "app-a"), Upstream("b", "https://b.test/v1", "app-b")], breakers)
+    breakers.get("a_chat_messages")._transition(OPEN)
+
+    assert {pool.pick().name for _ in range(20)} == {"b"}
+
+    # With every upstream ejected, calls still go somewhere rather than nowhere
+    breakers.get("b_chat_messages")._transition(OPEN)
+    assert pool.pick().name in ("a", "b")
+
+async def test_conversation_stays_on_the_upstream_that_created_it(pooled_client, apps):
+    first = await pooled_client.chat("hello")
+    origin = first["conversation_id"].split("-")[0]
+    other = "b" if origin == "a" else "a"
+
+    # The other upstream is now the less loaded one, but the conversation lives on the origin
+    upstream(pooled_client, origin).outstanding = 5
+    follow_up = await pooled_client.chat("again", conversation_id=first["conversation_id"])
+
+    assert follow_up["conversation_id"] == first["conversation_id"]
+    assert len(apps[origin].payloads) == 2
+    assert apps[other].payloads == []
+
+async def test_unknown_conversation_falls_back_through_the_candidates(pooled_client, apps):
+    # A conversation created by b before a restart; a is picked first
+    upstream(pooled_client, "b").outstanding = 1
+    result = await pooled_client.chat("again", conversation_id="b-7")
+
+    assert result["answer"] == "hi"
+    assert apps["a"].not_found == ["b-7"]
+    assert [p["conversation_id"] for p in apps["b"].payloads] == ["b-7"]
+
+    # Now bound to b, the next turn goes straight there
+    await pooled_client.chat("and again", conversation_id="b-7")
+    assert apps["a"].not_found == ["b-7"]
+    assert len(apps["b"].payloads) == 2